@@ -2,6 +2,9 @@
 """Python netcat implementation for TCP."""
 
 import argparse
+import os
+import select
+import selectors
 import socket
 import sys
 import threading
@@ -28,21 +31,106 @@ def b2str(data):
         return data.decode("latin-1")
 
 
+def write_fd(fd, data):
+    """Write all bytes to a file descriptor, even if it has been made non-blocking."""
+    view = memoryview(data)
+    while view:
+        try:
+            view = view[os.write(fd, view) :]
+        except BlockingIOError:
+            # stdin and stdout may share the same (now non-blocking) terminal
+            select.select([], [fd], [])
+
+
+class LineFramer:
+    """Incremental framer which splits a received byte stream into lines.
+
+    Data is appended to a single bytearray and complete lines are handed out from a read
+    cursor, so every byte is copied in and out once no matter how it was chunked. Partial
+    lines are kept until the rest of them arrives. Lines end with LF, a trailing CR is
+    stripped as well.
+    """
+
+    def __init__(self):
+        """Create an empty framer."""
+        self._buf = bytearray()
+        # Start of the next line
+        self._pos = 0
+        # Where to continue searching for a delimiter
+        self._scan = 0
+
+    def __len__(self):
+        """Return the number of buffered bytes which have not been handed out yet."""
+        return len(self._buf) - self._pos
+
+    def __iter__(self):
+        """Yield all complete lines which are currently buffered."""
+        line = self.next_frame()
+        while line is not None:
+            yield line
+            line = self.next_frame()
+
+    def feed(self, data):
+        """Append received data."""
+        # Drop what has already been handed out once it is worth the copy
+        if self._pos and self._pos >= len(self._buf) // 2:
+            del self._buf[: self._pos]
+            self._scan -= self._pos
+            self._pos = 0
+        self._buf += data
+
+    def next_frame(self):
+        """Return the next complete line (without delimiter) or None if there is none yet."""
+        buf = self._buf
+        pos = self._pos
+        end = buf.find(b"\n", self._scan)
+        if end == -1:
+            # Only search the new data next time
+            self._scan = len(buf)
+            return None
+        self._pos = self._scan = end + 1
+        if end > pos and buf[end - 1] == 0x0D:
+            end -= 1
+        return bytes(buf[pos:end])
+
+    def flush(self):
+        """Return and remove all buffered data which does not form a complete line yet."""
+        data = bytes(self._buf[self._pos :])
+        self._buf = bytearray()
+        self._pos = self._scan = 0
+        return data
+
+
 # -------------------------------------------------------------------------------------------------
 # CLIENT/SERVER FUNCTIONS
 # -------------------------------------------------------------------------------------------------
 
 
-def send(s, crlf=False, verbose=False):
+def send(s, crlf=False, done=None, verbose=False):
     """Send one newline terminated line to a connected socket."""
+    try:
+        _send(s, crlf=crlf, verbose=verbose)
+    finally:
+        # Wake up the main thread to do the cleanup
+        if done is not None:
+            done.set()
+
+
+def _send(s, crlf=False, verbose=False):
+    """Read lines from stdin and send them until stdin or the connection is gone."""
     # Loop for the thread
     while True:
         # Read user input
-        data = input()
+        try:
+            data = input()
+        except EOFError:
+            return
 
-        # Ensure to append newline
+        # Ensure to append newline, replacing a CRLF one
         if isinstance(data, bytes):
             data = b2str(data)
+        if data.endswith("\r"):
+            data = data[:-1]
         if crlf:
             data += "\r\n"
         else:
@@ -58,47 +146,265 @@ def send(s, crlf=False, verbose=False):
             # exit the thread
             return
 
-    # Close connection when thread stops
-    s.close()
-
 
-def receive(s, bufsize=1024, verbose=False):
+def receive(s, bufsize=1024, done=None, verbose=False):
     """Read one newline terminated line from a connected socket."""
+    try:
+        _receive(s, bufsize=bufsize, verbose=verbose)
+    finally:
+        # Wake up the main thread to do the cleanup
+        if done is not None:
+            done.set()
+
+
+def _receive(s, bufsize=1024, verbose=False):
+    """Read lines from the socket and print them until the connection is gone."""
+    framer = LineFramer()
+
     # Loop for the thread
     while True:
-        data = ""
-        size = len(data)
+        try:
+            data = s.recv(bufsize)
+        except socket.error as err:
+            print(err, file=sys.stderr)
+            s.close()
+            sys.exit(1)
+        if not data:
+            # Print whatever is left of an unterminated last line
+            if len(framer):
+                print(b2str(framer.flush()))
+            if verbose:
+                print("upstream connection is gone while receiving", file=sys.stderr)
+            s.close()
+            # exit the thread
+            return
+
+        framer.feed(data)
+        for line in framer:
+            if verbose:
+                print("< ", end="", flush=True, file=sys.stderr)
+            print(b2str(line))
+
+
+# -------------------------------------------------------------------------------------------------
+# THREADED ENGINE
+# -------------------------------------------------------------------------------------------------
+
 
+def run_threads(s, bufsize=1024, crlf=False, verbose=False):
+    """Send and receive on a connected socket and block until either side is gone."""
+    # Set by whichever thread finishes first
+    done = threading.Event()
+
+    # Start sending and receiving threads
+    tr = threading.Thread(
+        target=receive,
+        args=(s,),
+        kwargs={"bufsize": bufsize, "done": done, "verbose": verbose},
+    )
+    ts = threading.Thread(
+        target=send, args=(s,), kwargs={"crlf": crlf, "done": done, "verbose": verbose}
+    )
+    # If the main thread kills, this thread will be killed too.
+    tr.daemon = True
+    ts.daemon = True
+    # Start threads
+    tr.start()
+    ts.start()
+
+    # Sleep until one of the threads has finished
+    done.wait()
+
+
+# -------------------------------------------------------------------------------------------------
+# EVENT LOOP ENGINE
+# -------------------------------------------------------------------------------------------------
+
+
+def pollable_fd(fd, bufsize=1024):
+    """Return fd if the default selector is able to watch it, otherwise a pipe fed from it.
+
+    epoll refuses regular files and /dev/null (e.g. stdin redirected from a file). Instead of
+    falling back to select() for the socket, such an fd is read by a thread which copies its
+    data into a pipe and closes the pipe at EOF. The caller has to close the returned fd if it
+    is not the one passed in.
+    """
+    sel = selectors.DefaultSelector()
+    try:
+        sel.register(fd, selectors.EVENT_READ)
+        return fd
+    except PermissionError:
+        pass
+    finally:
+        sel.close()
+
+    rfd, wfd = os.pipe()
+
+    def copy():
+        """Copy fd into the pipe until EOF or until the reading end is closed."""
+        try:
+            while True:
+                data = os.read(fd, bufsize)
+                if not data:
+                    break
+                write_fd(wfd, data)
+        except OSError:
+            pass
+        finally:
+            os.close(wfd)
+
+    thread = threading.Thread(target=copy)
+    thread.daemon = True
+    thread.start()
+    return rfd
+
+
+def run_selectors(s, bufsize=1024, crlf=False, verbose=False):
+    """Send and receive on a connected socket from a single thread and return when done.
+
+    stdin and the socket are multiplexed via selectors (epoll on Linux). Reads are
+    non-blocking and data for the socket is kept in an outbound buffer, which is
+    flushed as far as the socket accepts it and otherwise waits for it to become writable.
+    """
+    stdin = pollable_fd(sys.stdin.fileno(), bufsize)
+    stdout = sys.stdout.fileno()
+    sys.stdout.flush()
+
+    # Stop reading stdin while this many bytes are still waiting for the socket
+    high_water = 64 * bufsize
+
+    sel = selectors.DefaultSelector()
+    s.setblocking(False)
+    os.set_blocking(stdin, False)
+
+    # Lines read from stdin, sent with the line ending asked for
+    lines = LineFramer()
+    newline = b"\r\n" if crlf else b"\n"
+
+    outbuf = bytearray()
+    stdin_open = True
+    stdin_registered = False
+    sock_events = 0
+
+    try:
         while True:
-            try:
-                data += b2str(s.recv(bufsize))
-            except socket.error as err:
-                print(err, file=sys.stderr)
-                s.close()
-                sys.exit(1)
-            if not data:
-                if verbose:
-                    print("upstream connection is gone while receiving", file=sys.stderr)
-                s.close()
-                # exit the thread
+            # Flush as much as possible right away and only wait for writability if needed
+            if outbuf:
+                try:
+                    del outbuf[: s.send(outbuf)]
+                except BlockingIOError:
+                    pass
+                except socket.error:
+                    if verbose:
+                        print("Upstream connection is gone while sending", file=sys.stderr)
+                    return
+
+            # Nothing left to do once stdin is gone and everything has been sent
+            if not stdin_open and not outbuf:
                 return
-            # Newline terminates the read request
-            if data.endswith("\n"):
-                break
-            # Sometimes a newline is missing at the end
-            # If this round has the same data length as previous, we're done
-            if size == len(data):
-                break
-            size = len(data)
-        # Remove trailing newlines
-        data = data.rstrip("\r\n")
-        data = data.rstrip("\n")
-        if verbose:
-            print("< ", end="", flush=True, file=sys.stderr)
-        print(data)
 
-    # Close connection when thread stops
-    s.close()
+            # Update what we are interested in
+            want_stdin = stdin_open and len(outbuf) < high_water
+            if want_stdin and not stdin_registered:
+                sel.register(stdin, selectors.EVENT_READ)
+                stdin_registered = True
+            elif not want_stdin and stdin_registered:
+                sel.unregister(stdin)
+                stdin_registered = False
+
+            events = selectors.EVENT_READ | (selectors.EVENT_WRITE if outbuf else 0)
+            if events != sock_events:
+                if sock_events:
+                    sel.modify(s, events)
+                else:
+                    sel.register(s, events)
+                sock_events = events
+
+            for key, mask in sel.select():
+                # Read user input
+                if key.fileobj == stdin:
+                    try:
+                        data = os.read(stdin, bufsize)
+                    except BlockingIOError:
+                        continue
+                    if not data:
+                        stdin_open = False
+                        # Send an unterminated last line as well
+                        if len(lines):
+                            line = lines.flush()
+                            outbuf += (line[:-1] if line.endswith(b"\r") else line) + newline
+                        continue
+                    lines.feed(data)
+                    for line in lines:
+                        outbuf += line + newline
+
+                # Read from socket
+                elif mask & selectors.EVENT_READ:
+                    try:
+                        data = s.recv(bufsize)
+                    except BlockingIOError:
+                        continue
+                    except socket.error as err:
+                        print(err, file=sys.stderr)
+                        return
+                    if not data:
+                        if verbose:
+                            print("upstream connection is gone while receiving", file=sys.stderr)
+                        return
+                    write_fd(stdout, data)
+    finally:
+        sel.close()
+        if stdin == sys.stdin.fileno():
+            os.set_blocking(stdin, True)
+        else:
+            os.close(stdin)
+
+
+# Available engines to shuffle data between stdin/stdout and the socket
+ENGINES = {
+    "threads": run_threads,
+    "selectors": run_selectors,
+}
+
+
+# -------------------------------------------------------------------------------------------------
+# SOCKET TUNING
+# -------------------------------------------------------------------------------------------------
+
+
+def set_sockopts(s, sockopts, verbose=False):
+    """Apply tuning options to a socket before it is bound or connected.
+
+    sockopts is a dict as returned by get_sockopts(). Options which are not set are left at
+    the system defaults. Accepted sockets inherit them from the listening socket.
+    """
+    options = []
+    if sockopts.get("reuseaddr"):
+        options.append(("SO_REUSEADDR", socket.SOL_SOCKET, socket.SO_REUSEADDR, 1))
+    if sockopts.get("reuseport"):
+        if not hasattr(socket, "SO_REUSEPORT"):
+            print("SO_REUSEPORT is not supported", file=sys.stderr)
+            s.close()
+            sys.exit(1)
+        options.append(("SO_REUSEPORT", socket.SOL_SOCKET, socket.SO_REUSEPORT, 1))
+    if sockopts.get("rcvbuf"):
+        options.append(("SO_RCVBUF", socket.SOL_SOCKET, socket.SO_RCVBUF, sockopts["rcvbuf"]))
+    if sockopts.get("sndbuf"):
+        options.append(("SO_SNDBUF", socket.SOL_SOCKET, socket.SO_SNDBUF, sockopts["sndbuf"]))
+    if sockopts.get("keepalive"):
+        options.append(("SO_KEEPALIVE", socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1))
+    if sockopts.get("nodelay"):
+        options.append(("TCP_NODELAY", socket.IPPROTO_TCP, socket.TCP_NODELAY, 1))
+
+    for name, level, option, value in options:
+        if verbose:
+            print("Sockopt:   ", name + "=" + str(value), file=sys.stderr)
+        try:
+            s.setsockopt(level, option, value)
+        except socket.error as msg:
+            s.close()
+            print(name + ": " + str(msg), file=sys.stderr)
+            sys.exit(1)
 
 
 # -------------------------------------------------------------------------------------------------
@@ -106,15 +412,16 @@ def receive(s, bufsize=1024, verbose=False):
 # -------------------------------------------------------------------------------------------------
 
 
-def connect(host, port, bufsize=1024, crlf=False, verbose=False):
+def connect(host, port, bufsize=1024, crlf=False, engine="threads", sockopts=None, verbose=False):
     """Connect to host:port and send data."""
     # Create socket
     try:
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     except socket.error as msg:
-        s.close()
         print(msg, file=sys.stderr)
         sys.exit(1)
+    if sockopts:
+        set_sockopts(s, sockopts, verbose=verbose)
 
     # Get remote IP
     if verbose:
@@ -136,26 +443,12 @@ def connect(host, port, bufsize=1024, crlf=False, verbose=False):
         print(msg, file=sys.stderr)
         sys.exit(1)
 
-    # Start sending and receiving threads
-    tr = threading.Thread(
-        target=receive, args=(s,), kwargs={"bufsize": bufsize, "verbose": verbose}
-    )
-    ts = threading.Thread(target=send, args=(s,), kwargs={"crlf": crlf, "verbose": verbose})
-    # If the main thread kills, this thread will be killed too.
-    tr.daemon = True
-    ts.daemon = True
-    # Start threads
-    tr.start()
-    ts.start()
+    run = ENGINES[engine]
+    run(s, bufsize=bufsize, crlf=crlf, verbose=verbose)
 
     # Do cleanup on the main program
-    while True:
-        if not tr.is_alive():
-            s.close()
-            sys.exit(0)
-        if not ts.is_alive():
-            s.close()
-            sys.exit(0)
+    s.close()
+    sys.exit(0)
 
 
 # -------------------------------------------------------------------------------------------------
@@ -163,12 +456,27 @@ def connect(host, port, bufsize=1024, crlf=False, verbose=False):
 # -------------------------------------------------------------------------------------------------
 
 
-def listen(host, port, backlog=1, bufsize=1024, crlf=False, verbose=False):
+def listen(
+    host,
+    port,
+    backlog=1,
+    bufsize=1024,
+    crlf=False,
+    engine="threads",
+    sockopts=None,
+    verbose=False,
+):
     """Listen on host:port and wait endlessly for client to send data."""
+    # Create server socket
     try:
-        # Create server socket
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    except socket.error as msg:
+        print(msg, file=sys.stderr)
+        sys.exit(1)
+    if sockopts:
+        set_sockopts(s, sockopts, verbose=verbose)
 
+    try:
         # Bind socket
         if verbose:
             print("Binding:   ", host + ":" + str(port), file=sys.stderr)
@@ -191,28 +499,13 @@ def listen(host, port, backlog=1, bufsize=1024, crlf=False, verbose=False):
         print("Connected: ", str(host) + ":" + str(port), file=sys.stderr)
         print("Receiving: ", "bufsize=" + str(bufsize), file=sys.stderr)
 
-    # Start sending and receiving threads
-    tr = threading.Thread(
-        target=receive, args=(c,), kwargs={"bufsize": bufsize, "verbose": verbose}
-    )
-    ts = threading.Thread(target=send, args=(c,), kwargs={"crlf": crlf, "verbose": verbose})
-    # If the main thread kills, this thread will be killed too.
-    tr.daemon = True
-    ts.daemon = True
-    # Start threads
-    tr.start()
-    ts.start()
+    run = ENGINES[engine]
+    run(c, bufsize=bufsize, crlf=crlf, verbose=verbose)
 
     # Do cleanup on the main program
-    while True:
-        if not tr.is_alive():
-            c.close()
-            s.close()
-            sys.exit(0)
-        if not ts.is_alive():
-            c.close()
-            s.close()
-            sys.exit(0)
+    c.close()
+    s.close()
+    sys.exit(0)
 
 
 # -------------------------------------------------------------------------------------------------
@@ -231,6 +524,86 @@ def _args_check_port(value):
     return intvalue
 
 
+def _args_check_size(value):
+    """Check arguments for invalid (non-positive) sizes."""
+    intvalue = int(value)
+
+    if intvalue < 1:
+        raise argparse.ArgumentTypeError("%s is an invalid size." % value)
+    return intvalue
+
+
+def add_sockopt_args(parser, backlog, bufsize):
+    """Add socket tuning arguments to the parser, using the given defaults."""
+    group = parser.add_argument_group("socket tuning")
+    group.add_argument(
+        "--backlog",
+        metavar="NUM",
+        type=_args_check_size,
+        default=backlog,
+        required=False,
+        help="length of the listen queue (default: %i)" % (backlog),
+    )
+    group.add_argument(
+        "--bufsize",
+        metavar="BYTES",
+        type=_args_check_size,
+        default=bufsize,
+        required=False,
+        help="number of bytes to read per recv() call (default: %i)" % (bufsize),
+    )
+    group.add_argument(
+        "--rcvbuf",
+        metavar="BYTES",
+        type=_args_check_size,
+        required=False,
+        help="kernel receive buffer size SO_RCVBUF (default: system)",
+    )
+    group.add_argument(
+        "--sndbuf",
+        metavar="BYTES",
+        type=_args_check_size,
+        required=False,
+        help="kernel send buffer size SO_SNDBUF (default: system)",
+    )
+    group.add_argument(
+        "--nodelay",
+        action="store_true",
+        required=False,
+        help="disable Nagle's algorithm (TCP_NODELAY)",
+    )
+    group.add_argument(
+        "--reuseaddr",
+        action="store_true",
+        required=False,
+        help="allow binding to an address in TIME_WAIT (SO_REUSEADDR)",
+    )
+    group.add_argument(
+        "--reuseport",
+        action="store_true",
+        required=False,
+        help="allow several sockets to bind the same port (SO_REUSEPORT)",
+    )
+    group.add_argument(
+        "--keepalive",
+        action="store_true",
+        required=False,
+        help="enable TCP keepalive probes (SO_KEEPALIVE)",
+    )
+
+
+def get_sockopts(args):
+    """Return the socket tuning options from the parsed arguments as dict."""
+    return {
+        "rcvbuf": args.rcvbuf,
+        "sndbuf": args.sndbuf,
+        "nodelay": args.nodelay,
+        "reuseaddr": args.reuseaddr,
+        "reuseport": args.reuseport,
+        "keepalive": args.keepalive,
+    }
+
+
 def get_args():
     """Retrieve command line arguments."""
     parser = argparse.ArgumentParser(description="Netcat implementation in Python.")
@@ -255,8 +628,17 @@ def get_args():
         required=False,
         help="be verbose and print info to stderr",
     )
+    parser.add_argument(
+        "--engine",
+        choices=sorted(ENGINES),
+        default="threads",
+        required=False,
+        help="threads: one thread per direction, selectors: single-threaded event loop "
+        "(default: threads)",
+    )
     parser.add_argument("hostname", type=str, help="address to listen or connect to")
     parser.add_argument("port", type=_args_check_port, help="port to listen on or connect to")
+    add_sockopt_args(parser, backlog=1, bufsize=1024)
     return parser.parse_args()
 
 
@@ -269,22 +651,27 @@ def main():
     """Start the program."""
     args = get_args()
 
-    listen_backlog = 1
-    receive_buffer = 1024
-
     if args.listen:
         listen(
             args.hostname,
             args.port,
-            backlog=listen_backlog,
-            bufsize=receive_buffer,
+            backlog=args.backlog,
+            bufsize=args.bufsize,
             crlf=args.crlf,
+            engine=args.engine,
+            sockopts=get_sockopts(args),
             verbose=args.verbose,
         )
 
     else:
         connect(
-            args.hostname, args.port, bufsize=receive_buffer, crlf=args.crlf, verbose=args.verbose
+            args.hostname,
+            args.port,
+            bufsize=args.bufsize,
+            crlf=args.crlf,
+            engine=args.engine,
+            sockopts=get_sockopts(args),
+            verbose=args.verbose,
         )
 
 
@@ -2,21 +2,52 @@
 """Python netcat implementation for TCP and UDP."""
 
 import argparse
+import os
+import select
+import selectors
 import socket
+import stat
 import sys
 import threading
+import time
 
 
 # -------------------------------------------------------------------------------------------------
-# GLOBALS
+# THREAD COORDINATION
 # -------------------------------------------------------------------------------------------------
 
-# In case the server is running in UDP mode
-# it must wait for the client to connect in order
-# to retrieve its addr and port in order to be able
-# to send data back to it.
-UDP_CLIENT_ADDR = None
-UDP_CLIENT_PORT = None
+
+class Peer:
+    """Hand over the remote UDP addr/port from the receiving to the sending thread.
+
+    In case the server is running in UDP mode it must wait for the client to connect
+    in order to retrieve its addr and port in order to be able to send data back to it.
+    The sending thread blocks on an event instead of polling until it is known.
+    """
+
+    def __init__(self, addr=None, port=None):
+        """Create a peer, which is immediately available if addr/port are given."""
+        self._lock = threading.Lock()
+        self._known = threading.Event()
+        self._addr = None
+        if addr is not None and port is not None:
+            self.set(addr, port)
+
+    def set(self, addr, port):
+        """Store the remote addr/port and wake up everybody waiting for it."""
+        with self._lock:
+            self._addr = (addr, port)
+        self._known.set()
+
+    def get(self):
+        """Return the remote (addr, port) tuple or None if not yet known."""
+        with self._lock:
+            return self._addr
+
+    def wait(self, timeout=None):
+        """Block until the remote addr/port is known and return it."""
+        self._known.wait(timeout)
+        return self.get()
 
 
 # -------------------------------------------------------------------------------------------------
@@ -40,45 +71,160 @@ def b2str(data):
         return data.decode("latin-1")
 
 
+def write_fd(fd, data):
+    """Write all bytes to a file descriptor, even if it has been made non-blocking."""
+    view = memoryview(data)
+    while view:
+        try:
+            view = view[os.write(fd, view) :]
+        except BlockingIOError:
+            # stdin and stdout may share the same (now non-blocking) terminal
+            select.select([], [fd], [])
+
+
+class Framer:
+    """Incremental framer which splits a received byte stream into messages.
+
+    Data is appended to a single bytearray and complete frames are handed out from a read
+    cursor, so every byte is copied in and out once no matter how it was chunked. Partial
+    frames are kept until the rest of them arrives.
+
+    Supported framings:
+        lf:     newline terminated (a trailing CR is stripped as well)
+        crlf:   CRLF terminated
+        nul:    NUL terminated
+        length: 4 byte big-endian length prefix followed by the payload
+    """
+
+    DELIMITERS = {"lf": b"\n", "crlf": b"\r\n", "nul": b"\0", "length": None}
+
+    def __init__(self, framing="lf", max_size=None):
+        """Create a framer for the given framing, optionally limiting the frame size."""
+        if framing not in self.DELIMITERS:
+            raise ValueError("Unknown framing: %s" % (framing))
+        self.framing = framing
+        self.max_size = max_size
+        self._delim = self.DELIMITERS[framing]
+        self._buf = bytearray()
+        # Start of the next frame
+        self._pos = 0
+        # Where to continue searching for a delimiter
+        self._scan = 0
+
+    def __len__(self):
+        """Return the number of buffered bytes which have not been handed out yet."""
+        return len(self._buf) - self._pos
+
+    def __iter__(self):
+        """Yield all complete frames which are currently buffered."""
+        frame = self.next_frame()
+        while frame is not None:
+            yield frame
+            frame = self.next_frame()
+
+    def feed(self, data):
+        """Append received data."""
+        # Drop what has already been handed out once it is worth the copy
+        if self._pos and self._pos >= len(self._buf) // 2:
+            del self._buf[: self._pos]
+            self._scan -= self._pos
+            self._pos = 0
+        self._buf += data
+
+    def next_frame(self):
+        """Return the next complete frame (without delimiter) or None if there is none yet.
+
+        Raises ValueError if the frame is larger than max_size.
+        """
+        buf = self._buf
+        pos = self._pos
+
+        if self._delim is None:
+            if len(buf) - pos < 4:
+                return None
+            size = int.from_bytes(buf[pos : pos + 4], "big")
+            self._check_size(size)
+            if len(buf) - pos - 4 < size:
+                return None
+            self._pos = self._scan = pos + 4 + size
+            return bytes(buf[pos + 4 : self._pos])
+
+        end = buf.find(self._delim, self._scan)
+        if end == -1:
+            # Only search the new data next time, a delimiter could start in the last byte
+            self._scan = max(pos, len(buf) - len(self._delim) + 1)
+            self._check_size(len(buf) - pos)
+            return None
+        self._check_size(end - pos)
+        self._pos = self._scan = end + len(self._delim)
+        if self.framing == "lf" and end > pos and buf[end - 1] == 0x0D:
+            end -= 1
+        return bytes(buf[pos:end])
+
+    def pack(self, payload):
+        """Return payload framed for sending."""
+        if self._delim is None:
+            return len(payload).to_bytes(4, "big") + payload
+        return payload + self._delim
+
+    def flush(self):
+        """Return and remove all buffered data which does not form a complete frame yet."""
+        data = bytes(self._buf[self._pos :])
+        self._buf = bytearray()
+        self._pos = self._scan = 0
+        return data
+
+    def _check_size(self, size):
+        """Raise ValueError if size exceeds the frame size limit."""
+        if self.max_size is not None and size > self.max_size:
+            raise ValueError("Frame exceeds %i bytes" % (self.max_size))
+
+
 # -------------------------------------------------------------------------------------------------
 # CLIENT/SERVER COMMUNICATOIN FUNCTIONS
 # -------------------------------------------------------------------------------------------------
 
 
-def send(s, udp=False, crlf=False, verbose=False):
+def send(s, udp=False, peer=None, crlf=False, framing="lf", done=None, verbose=False):
     """Send one newline terminated line to a connected socket."""
+    try:
+        _send(s, udp=udp, peer=peer, crlf=crlf, framing=framing, verbose=verbose)
+    finally:
+        # Wake up the main thread to do the cleanup
+        if done is not None:
+            done.set()
+
+
+def _send(s, udp=False, peer=None, crlf=False, framing="lf", verbose=False):
+    """Read lines from stdin and send them until stdin or the connection is gone."""
     # In case of sending data back to an udp client we need to wait
     # until the client has first connected and told us its addr/port
-    if udp and UDP_CLIENT_ADDR is None and UDP_CLIENT_PORT is None:
-        while UDP_CLIENT_ADDR is None and UDP_CLIENT_PORT is None:
-            pass
+    if udp and peer.get() is None:
+        addr, port = peer.wait()
         if verbose:
-            print("Client:     %s:%i" % (UDP_CLIENT_ADDR, UDP_CLIENT_PORT), file=sys.stderr)
+            print("Client:     %s:%i" % (addr, port), file=sys.stderr)
+
+    # Ensure to terminate with desired newline
+    framer = Framer("crlf" if crlf and framing == "lf" else framing)
 
     # Loop for the thread
     while True:
         # Read user input
-        data = input()
+        try:
+            data = input()
+        except EOFError:
+            return
 
-        # Ensure to terminate with desired newline
-        if isinstance(data, bytes):
-            data = b2str(data)
-        if crlf:
-            data += "\r\n"
-        else:
-            data += "\n"
-
-        size = len(data)
-        data = data.encode()
+        data = memoryview(framer.pack(data.encode()))
         send = 0
 
         # Loop until all bytes have been send
-        while send < size:
+        while send < len(data):
             try:
                 if udp:
-                    send += s.sendto(data, (UDP_CLIENT_ADDR, UDP_CLIENT_PORT))
+                    send += s.sendto(data[send:], peer.get())
                 else:
-                    send += s.send(data)
+                    send += s.send(data[send:])
             except (OSError, socket.error) as error:
                 print("[Send Error] %s" % (error), file=sys.stderr)
                 print(s, file=sys.stderr)
@@ -86,62 +232,58 @@ def send(s, udp=False, crlf=False, verbose=False):
                 # exit the thread
                 return
 
-    # Close connection when thread stops
-    s.close()
-
 
-def receive(s, udp=False, bufsize=1024, verbose=False):
+def receive(s, udp=False, peer=None, bufsize=1024, framing="lf", done=None, verbose=False):
     """Read one newline terminated line from a connected socket."""
-    global UDP_CLIENT_ADDR
-    global UDP_CLIENT_PORT
+    try:
+        _receive(s, udp=udp, peer=peer, bufsize=bufsize, framing=framing, verbose=verbose)
+    finally:
+        # Wake up the main thread to do the cleanup
+        if done is not None:
+            done.set()
 
+
+def _receive(s, udp=False, peer=None, bufsize=1024, framing="lf", verbose=False):
+    """Read lines from the socket and print them until the connection is gone."""
     if verbose:
         print("Receiving:  bufsize=%i" % (bufsize), file=sys.stderr)
 
+    framer = Framer(framing)
+
     # Loop for the thread
     while True:
-        data = ""
-        size = len(data)
-
-        while True:
-            try:
-                (byte, addr) = s.recvfrom(bufsize)
-                data += b2str(byte)
+        try:
+            (data, addr) = s.recvfrom(bufsize)
+        except socket.error as err:
+            print(err, file=sys.stderr)
+            print(s, file=sys.stderr)
+            s.close()
+            sys.exit(1)
 
-                # If we're receiving data from a UDP client
-                # we can finally set its addr/port in order
-                # to send data back to it (see send() function)
-                if udp:
-                    UDP_CLIENT_ADDR, UDP_CLIENT_PORT = addr
+        # If we're receiving data from a UDP client
+        # we can finally set its addr/port in order
+        # to send data back to it (see send() function)
+        if udp:
+            peer.set(*addr)
+        elif not data:
+            # Print whatever is left of an unterminated last line
+            if len(framer):
+                print(b2str(framer.flush()))
+            if verbose:
+                print("[Receive Error] Upstream connection is gone", file=sys.stderr)
+            s.close()
+            # exit the thread
+            return
 
-            except socket.error as err:
-                print(err, file=sys.stderr)
-                print(s, file=sys.stderr)
-                s.close()
-                sys.exit(1)
-            if not data:
-                if verbose:
-                    print("[Receive Error] Upstream connection is gone", file=sys.stderr)
-                s.close()
-                # exit the thread
-                return
-            # Newline terminates the read request
-            if data.endswith("\n"):
-                break
-            # Sometimes a newline is missing at the end
-            # If this round has the same data length as previous, we're done
-            if size == len(data):
-                break
-            size = len(data)
-        # Remove trailing newlines
-        data = data.rstrip("\r\n")
-        data = data.rstrip("\n")
-        if verbose:
-            print("< ", end="", flush=True, file=sys.stderr)
-        print(data)
+        framer.feed(data)
+        for frame in framer:
+            if verbose:
+                print("< ", end="", flush=True, file=sys.stderr)
+            print(b2str(frame))
 
-    # Close connection when thread stops
-    s.close()
+        # A datagram is a message of its own, even without a terminating newline
+        if udp and len(framer):
+            print(b2str(framer.flush()))
 
 
 # -------------------------------------------------------------------------------------------------
@@ -151,20 +293,61 @@ def receive(s, udp=False, bufsize=1024, verbose=False):
 #
 # Server/Client (TCP+UDP)
 #
-def create_socket(udp=False, verbose=False):
+def create_socket(udp=False, sockopts=None, verbose=False):
     """Create TCP or UDP socket."""
     try:
         if udp:
             if verbose:
                 print("Socket:     UDP", file=sys.stderr)
-            return socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         else:
             if verbose:
                 print("Socket:     TCP", file=sys.stderr)
-            return socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     except socket.error as error:
         print("[Socker Error] %s", (error), file=sys.stderr)
         sys.exit(1)
+    if sockopts:
+        set_sockopts(s, sockopts, udp=udp, verbose=verbose)
+    return s
+
+
+#
+# Server/Client (TCP+UDP)
+#
+def set_sockopts(s, sockopts, udp=False, verbose=False):
+    """Apply tuning options to a socket before it is bound or connected.
+
+    sockopts is a dict as returned by get_sockopts(). Options which are not set are left at
+    the system defaults. Accepted sockets inherit them from the listening socket.
+    """
+    options = []
+    if sockopts.get("reuseaddr"):
+        options.append(("SO_REUSEADDR", socket.SOL_SOCKET, socket.SO_REUSEADDR, 1))
+    if sockopts.get("reuseport"):
+        if not hasattr(socket, "SO_REUSEPORT"):
+            print("[Socket Error] SO_REUSEPORT is not supported", file=sys.stderr)
+            s.close()
+            sys.exit(1)
+        options.append(("SO_REUSEPORT", socket.SOL_SOCKET, socket.SO_REUSEPORT, 1))
+    if sockopts.get("rcvbuf"):
+        options.append(("SO_RCVBUF", socket.SOL_SOCKET, socket.SO_RCVBUF, sockopts["rcvbuf"]))
+    if sockopts.get("sndbuf"):
+        options.append(("SO_SNDBUF", socket.SOL_SOCKET, socket.SO_SNDBUF, sockopts["sndbuf"]))
+    if sockopts.get("keepalive") and not udp:
+        options.append(("SO_KEEPALIVE", socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1))
+    if sockopts.get("nodelay") and not udp:
+        options.append(("TCP_NODELAY", socket.IPPROTO_TCP, socket.TCP_NODELAY, 1))
+
+    for name, level, option, value in options:
+        if verbose:
+            print("Sockopt:    %s=%i" % (name, value), file=sys.stderr)
+        try:
+            s.setsockopt(level, option, value)
+        except (OSError, socket.error) as error:
+            print("[Socket Error] %s: %s" % (name, error), file=sys.stderr)
+            s.close()
+            sys.exit(1)
 
 
 #
@@ -249,51 +432,367 @@ def connect(s, addr, port, verbose=False):
         sys.exit(1)
 
 
+# -------------------------------------------------------------------------------------------------
+# THREADED ENGINE
+# -------------------------------------------------------------------------------------------------
+
+
+def run_threads(s, udp=False, peer=None, bufsize=1024, crlf=False, framing="lf", verbose=False):
+    """Send and receive on a connected socket and block until either side is gone."""
+    # Set by whichever thread finishes first
+    done = threading.Event()
+
+    # Start sending and receiving threads
+    kwargs = {"udp": udp, "peer": peer, "framing": framing, "done": done, "verbose": verbose}
+    tr = threading.Thread(target=receive, args=(s,), kwargs=dict(kwargs, bufsize=bufsize))
+    ts = threading.Thread(target=send, args=(s,), kwargs=dict(kwargs, crlf=crlf))
+    # If the main thread kills, this thread will be killed too.
+    tr.daemon = True
+    ts.daemon = True
+    # Start threads
+    tr.start()
+    ts.start()
+
+    # Sleep until one of the threads has finished
+    done.wait()
+
+
+# -------------------------------------------------------------------------------------------------
+# EVENT LOOP ENGINE
+# -------------------------------------------------------------------------------------------------
+
+
+def pollable_fd(fd, bufsize=1024):
+    """Return fd if the default selector is able to watch it, otherwise a pipe fed from it.
+
+    epoll refuses regular files and /dev/null (e.g. stdin redirected from a file). Instead of
+    falling back to select() for all sockets, such an fd is read by a thread which copies its
+    data into a pipe and closes the pipe at EOF. The caller has to close the returned fd if it
+    is not the one passed in.
+    """
+    sel = selectors.DefaultSelector()
+    try:
+        sel.register(fd, selectors.EVENT_READ)
+        return fd
+    except PermissionError:
+        pass
+    finally:
+        sel.close()
+
+    rfd, wfd = os.pipe()
+
+    def copy():
+        """Copy fd into the pipe until EOF or until the reading end is closed."""
+        try:
+            while True:
+                data = os.read(fd, bufsize)
+                if not data:
+                    break
+                write_fd(wfd, data)
+        except OSError:
+            pass
+        finally:
+            os.close(wfd)
+
+    thread = threading.Thread(target=copy)
+    thread.daemon = True
+    thread.start()
+    return rfd
+
+
+def run_selectors(s, udp=False, peer=None, bufsize=1024, crlf=False, framing="lf", verbose=False):
+    """Send and receive on a connected socket from a single thread and return when done.
+
+    stdin and the socket are multiplexed via selectors (epoll on Linux). Reads are
+    non-blocking and data for the socket is kept in an outbound buffer, which is
+    flushed as far as the socket accepts it and otherwise waits for it to become writable.
+    """
+    stdin = pollable_fd(sys.stdin.fileno(), bufsize)
+    stdout = sys.stdout.fileno()
+    sys.stdout.flush()
+
+    # Stop reading stdin while this many bytes are still waiting for the socket
+    high_water = 64 * bufsize
+
+    if verbose:
+        print("Receiving:  bufsize=%i" % (bufsize), file=sys.stderr)
+
+    sel = selectors.DefaultSelector()
+    s.setblocking(False)
+    os.set_blocking(stdin, False)
+
+    # Lines read from stdin, framed for sending
+    lines = Framer("lf")
+    outbound = Framer("crlf" if crlf and framing == "lf" else framing)
+    # Frames received from the socket
+    inbound = Framer(framing)
+
+    outbuf = bytearray()
+    stdin_open = True
+    stdin_registered = False
+    sock_events = 0
+
+    try:
+        while True:
+            # Only send to an UDP client once we know who it is
+            sendable = outbuf and (not udp or peer.get() is not None)
+
+            # Flush as much as possible right away and only wait for writability if needed
+            if sendable:
+                try:
+                    if udp:
+                        sent = s.sendto(outbuf, peer.get())
+                    else:
+                        sent = s.send(outbuf)
+                    del outbuf[:sent]
+                except BlockingIOError:
+                    pass
+                except (OSError, socket.error) as error:
+                    print("[Send Error] %s" % (error), file=sys.stderr)
+                    return
+                sendable = outbuf and (not udp or peer.get() is not None)
+
+            # Nothing left to do once stdin is gone and everything has been sent
+            if not stdin_open and not outbuf:
+                return
+
+            # Update what we are interested in
+            want_stdin = stdin_open and len(outbuf) < high_water
+            if want_stdin and not stdin_registered:
+                sel.register(stdin, selectors.EVENT_READ)
+                stdin_registered = True
+            elif not want_stdin and stdin_registered:
+                sel.unregister(stdin)
+                stdin_registered = False
+
+            events = selectors.EVENT_READ | (selectors.EVENT_WRITE if sendable else 0)
+            if events != sock_events:
+                if sock_events:
+                    sel.modify(s, events)
+                else:
+                    sel.register(s, events)
+                sock_events = events
+
+            for key, mask in sel.select():
+                # Read user input
+                if key.fileobj == stdin:
+                    try:
+                        data = os.read(stdin, bufsize)
+                    except BlockingIOError:
+                        continue
+                    if not data:
+                        stdin_open = False
+                        # Send an unterminated last line as well
+                        if len(lines):
+                            outbuf += outbound.pack(lines.flush())
+                        continue
+                    lines.feed(data)
+                    for line in lines:
+                        outbuf += outbound.pack(line)
+
+                # Read from socket
+                elif mask & selectors.EVENT_READ:
+                    try:
+                        (data, addr) = s.recvfrom(bufsize)
+                    except BlockingIOError:
+                        continue
+                    except (OSError, socket.error) as error:
+                        print("[Receive Error] %s" % (error), file=sys.stderr)
+                        return
+                    if not data and not udp:
+                        # Print whatever is left of an unterminated last line
+                        if len(inbound):
+                            write_fd(stdout, inbound.flush() + b"\n")
+                        if verbose:
+                            print("[Receive Error] Upstream connection is gone", file=sys.stderr)
+                        return
+                    # If we're receiving data from a UDP client we can
+                    # finally set its addr/port in order to send data back to it
+                    if udp:
+                        if verbose and peer.get() is None:
+                            print("Client:     %s:%i" % addr, file=sys.stderr)
+                        peer.set(*addr)
+                    inbound.feed(data)
+                    frames = [frame + b"\n" for frame in inbound]
+                    # A datagram is a message of its own, even without a terminating newline
+                    if udp and len(inbound):
+                        frames.append(inbound.flush() + b"\n")
+                    if frames:
+                        write_fd(stdout, b"".join(frames))
+    finally:
+        sel.close()
+        if stdin == sys.stdin.fileno():
+            os.set_blocking(stdin, True)
+        else:
+            os.close(stdin)
+
+
+# -------------------------------------------------------------------------------------------------
+# STREAM ENGINE
+# -------------------------------------------------------------------------------------------------
+
+# Minimum chunk size used by the stream engine
+STREAM_BUFSIZE = 262144
+
+# Seconds stdin may stay idle after the remote side has closed before sending stops
+STREAM_IDLE = 1.0
+
+# Maximum payload of a single UDP datagram
+MAX_DATAGRAM = 65507
+
+
+def stream_send(s, udp=False, peer=None, bufsize=STREAM_BUFSIZE, done=None, verbose=False):
+    """Copy stdin unmodified to the socket until stdin is exhausted.
+
+    A regular file on stdin is handed to the kernel via sendfile(). Anything else is read
+    into a single reused buffer and sent from a memoryview of it without further copies.
+    Once done is set by the receiver, sending stops as soon as stdin stays idle for
+    STREAM_IDLE seconds.
+    """
+    stdin = open(sys.stdin.fileno(), "rb", buffering=0, closefd=False)
+    try:
+        # In case of sending data back to an udp client we need to wait
+        # until the client has first connected and told us its addr/port
+        if udp and peer.get() is None:
+            addr, port = peer.wait()
+            if verbose:
+                print("Client:     %s:%i" % (addr, port), file=sys.stderr)
+
+        if not udp and stat.S_ISREG(os.fstat(stdin.fileno()).st_mode):
+            if verbose:
+                print("Sending:    sendfile", file=sys.stderr)
+            s.sendfile(stdin)
+        else:
+            # A single UDP datagram can't carry more than this
+            buf = bytearray(min(bufsize, MAX_DATAGRAM) if udp else bufsize)
+            view = memoryview(buf)
+            while True:
+                # Don't block on an idle stdin, which would outlive the connection
+                if done is not None and not select.select([stdin], [], [], STREAM_IDLE)[0]:
+                    if done.is_set():
+                        break
+                    continue
+                size = stdin.readinto(buf)
+                if not size:
+                    break
+                if udp:
+                    s.sendto(view[:size], peer.get())
+                else:
+                    s.sendall(view[:size])
+
+        # Let the other side know we're done, but keep receiving until it is done as well
+        if not udp:
+            s.shutdown(socket.SHUT_WR)
+    except (OSError, socket.error) as error:
+        print("[Send Error] %s" % (error), file=sys.stderr)
+    finally:
+        stdin.close()
+        if done is not None:
+            done.set()
+
+
+def stream_receive(s, udp=False, peer=None, bufsize=STREAM_BUFSIZE, done=None, verbose=False):
+    """Copy everything unmodified from the socket to stdout until the connection is gone."""
+    stdout = sys.stdout.fileno()
+    buf = bytearray(bufsize)
+    view = memoryview(buf)
+    try:
+        while True:
+            size, addr = s.recvfrom_into(buf)
+            if udp:
+                peer.set(*addr)
+            elif not size:
+                if verbose:
+                    print("[Receive Error] Upstream connection is gone", file=sys.stderr)
+                return
+            write_fd(stdout, view[:size])
+    except (OSError, socket.error) as error:
+        print("[Receive Error] %s" % (error), file=sys.stderr)
+    finally:
+        if done is not None:
+            done.set()
+
+
+def run_stream(s, udp=False, peer=None, bufsize=1024, crlf=False, framing="lf", verbose=False):
+    """Relay raw bytes between stdin/stdout and a connected socket until it is closed.
+
+    Unlike the line based engines nothing is decoded, re-encoded or translated (crlf and
+    framing are ignored), which makes it safe for binary data. With TCP the socket is
+    half-closed once stdin is exhausted and the relay ends when both directions are finished.
+    """
+    bufsize = max(bufsize, STREAM_BUFSIZE)
+    sys.stdout.flush()
+
+    if verbose:
+        print("Receiving:  bufsize=%i" % (bufsize), file=sys.stderr)
+
+    # Set by whichever thread finishes first
+    done = threading.Event()
+
+    kwargs = {"udp": udp, "peer": peer, "bufsize": bufsize, "done": done, "verbose": verbose}
+    tr = threading.Thread(target=stream_receive, args=(s,), kwargs=kwargs)
+    ts = threading.Thread(target=stream_send, args=(s,), kwargs=kwargs)
+    # If the main thread kills, this thread will be killed too.
+    tr.daemon = True
+    ts.daemon = True
+    # Start threads
+    tr.start()
+    ts.start()
+
+    if udp:
+        # There is no end of an UDP stream, stop as soon as either side is done
+        done.wait()
+    else:
+        # Wait for the remote side to close, then for the rest of stdin to be sent. Only an
+        # interactive terminal is left behind, the sender ends an idle pipe on its own
+        tr.join()
+        if not os.isatty(sys.stdin.fileno()):
+            ts.join()
+
+
+# Available engines to shuffle data between stdin/stdout and the socket
+ENGINES = {
+    "threads": run_threads,
+    "selectors": run_selectors,
+    "stream": run_stream,
+}
+
+
 # -------------------------------------------------------------------------------------------------
 # CLIENT
 # -------------------------------------------------------------------------------------------------
 
 
-def run_client(host, port, udp=False, bufsize=1024, crlf=False, verbose=False):
+def run_client(
+    host,
+    port,
+    udp=False,
+    bufsize=1024,
+    crlf=False,
+    framing="lf",
+    engine="threads",
+    sockopts=None,
+    verbose=False,
+):
     """Connect to host:port and send data."""
-    global UDP_CLIENT_ADDR
-    global UDP_CLIENT_PORT
-
-    s = create_socket(udp=udp, verbose=verbose)
+    s = create_socket(udp=udp, sockopts=sockopts, verbose=verbose)
 
     addr = resolve(host, verbose=verbose)
     if not addr:
         s.close()
         sys.exit(1)
 
+    peer = None
     if udp:
-        UDP_CLIENT_ADDR = addr
-        UDP_CLIENT_PORT = port
+        peer = Peer(addr, port)
     else:
         connect(s, addr, port, verbose=verbose)
 
-    # Start sending and receiving threads
-    tr = threading.Thread(
-        target=receive, args=(s,), kwargs={"udp": udp, "bufsize": bufsize, "verbose": verbose}
-    )
-    ts = threading.Thread(
-        target=send, args=(s,), kwargs={"udp": udp, "crlf": crlf, "verbose": verbose}
-    )
-    # If the main thread kills, this thread will be killed too.
-    tr.daemon = True
-    ts.daemon = True
-    # Start threads
-    tr.start()
-    ts.start()
+    run = ENGINES[engine]
+    run(s, udp=udp, peer=peer, bufsize=bufsize, crlf=crlf, framing=framing, verbose=verbose)
 
-    # Do cleanup on the main program
-    while True:
-        if not tr.is_alive():
-            s.close()
-            sys.exit(0)
-        if not ts.is_alive():
-            s.close()
-            sys.exit(0)
+    s.close()
+    sys.exit(0)
 
 
 # -------------------------------------------------------------------------------------------------
@@ -301,42 +800,226 @@ def run_client(host, port, udp=False, bufsize=1024, crlf=False, verbose=False):
 # -------------------------------------------------------------------------------------------------
 
 
-def run_server(host, port, udp=False, backlog=1, bufsize=1024, crlf=False, verbose=False):
+def run_server(
+    host,
+    port,
+    udp=False,
+    backlog=1,
+    bufsize=1024,
+    crlf=False,
+    framing="lf",
+    engine="threads",
+    sockopts=None,
+    verbose=False,
+):
     """Start TCP/UDP server on host/port and wait endlessly to sent/receive data."""
-    s = create_socket(udp=udp, verbose=verbose)
+    s = create_socket(udp=udp, sockopts=sockopts, verbose=verbose)
 
     bind(s, host, port, verbose=verbose)
 
+    peer = None
     if not udp:
         listen(s, backlog=backlog, verbose=verbose)
         c = accept(s, verbose=verbose)
     else:
         c = s
+        peer = Peer()
 
-    # start sending and receiving threads
-    tr = threading.Thread(
-        target=receive, args=(c,), kwargs={"udp": udp, "bufsize": bufsize, "verbose": verbose}
-    )
-    ts = threading.Thread(
-        target=send, args=(c,), kwargs={"udp": udp, "crlf": crlf, "verbose": verbose}
-    )
-    # if the main thread kills, this thread will be killed too.
-    tr.daemon = True
-    ts.daemon = True
-    # start threads
-    tr.start()
-    ts.start()
+    run = ENGINES[engine]
+    run(c, udp=udp, peer=peer, bufsize=bufsize, crlf=crlf, framing=framing, verbose=verbose)
+
+    c.close()
+    s.close()
+    sys.exit(0)
+
+
+# -------------------------------------------------------------------------------------------------
+# CHAT SERVER
+# -------------------------------------------------------------------------------------------------
 
-    # do cleanup on the main program
-    while True:
-        if not tr.is_alive():
-            c.close()
-            s.close()
-            sys.exit(0)
-        if not ts.is_alive():
-            c.close()
-            s.close()
-            sys.exit(0)
+
+class ChatClient:
+    """State of one client connected to the chat server."""
+
+    def __init__(self, sock, host, port, max_line):
+        """Wrap an accepted non-blocking client socket."""
+        self.sock = sock
+        self.name = ("%s:%i" % (host, port)).encode()
+        # Splits the received data into lines
+        self.lines = Framer("lf", max_size=max_line)
+        # Messages queued for this client only
+        self.outbuf = bytearray()
+        # Events currently registered with the selector
+        self.events = selectors.EVENT_READ
+
+
+def run_chat(
+    host,
+    port,
+    backlog=1,
+    bufsize=1024,
+    crlf=False,
+    max_queue=1048576,
+    sockopts=None,
+    verbose=False,
+):
+    """Start a TCP chat server on host/port and relay lines between any number of clients.
+
+    Every line received from a client is prefixed with its IP address and the time and sent
+    to all other clients. Each client has its own outbound queue, which is flushed once per
+    round as far as its socket accepts. Clients whose queue grows beyond max_queue bytes
+    can't keep up and get disconnected, so they never stall the others.
+    """
+    newline = b"\r\n" if crlf else b"\n"
+    max_line = 64 * bufsize
+
+    s = create_socket(sockopts=sockopts, verbose=verbose)
+    bind(s, host, port, verbose=verbose)
+    listen(s, backlog=max(backlog, socket.SOMAXCONN), verbose=verbose)
+    s.setblocking(False)
+
+    stdin = pollable_fd(sys.stdin.fileno(), bufsize)
+    stdout = sys.stdout.fileno()
+    sys.stdout.flush()
+
+    sel = selectors.DefaultSelector()
+    sel.register(s, selectors.EVENT_READ)
+    sel.register(stdin, selectors.EVENT_READ)
+    os.set_blocking(stdin, False)
+
+    clients = set()
+    # Clients with new data in their outbound queue since the last flush
+    pending = set()
+    # Clients to disconnect after the current round
+    gone = {}
+    # Lines typed by the server operator
+    operator = Framer("lf")
+    # Time string used as message prefix, refreshed once per second
+    clock = [0, b""]
+
+    def log(message):
+        """Print a timestamped server message to stderr."""
+        print("[%s] %s" % (time.strftime("%H:%M:%S"), message), file=sys.stderr)
+
+    def broadcast(sender, name, lines):
+        """Queue lines from sender to every other client and echo them to stdout."""
+        second = int(time.time())
+        if second != clock[0]:
+            clock[0] = second
+            clock[1] = time.strftime("%H:%M:%S", time.localtime(second)).encode()
+        head = b"[" + name + b" " + clock[1] + b"] "
+        data = b"".join([head + line + newline for line in lines])
+
+        write_fd(stdout, data)
+        for client in clients:
+            if client is sender or client in gone:
+                continue
+            if len(client.outbuf) + len(data) > max_queue:
+                gone[client] = "is too slow, disconnected"
+                continue
+            client.outbuf += data
+            pending.add(client)
+
+    def disconnect(client, reason):
+        """Close a client connection and forget about it."""
+        sel.unregister(client.sock)
+        client.sock.close()
+        clients.discard(client)
+        pending.discard(client)
+        log("Client %s %s" % (client.name.decode(), reason))
+
+    try:
+        while True:
+            for key, mask in sel.select():
+                # New clients, accept all of them which are waiting
+                if key.fileobj is s:
+                    while True:
+                        try:
+                            c, (h, p) = s.accept()
+                        except BlockingIOError:
+                            break
+                        except (OSError, socket.error) as error:
+                            print("[Accept Error] %s" % (error), file=sys.stderr)
+                            break
+                        c.setblocking(False)
+                        client = ChatClient(c, h, p, max_line)
+                        clients.add(client)
+                        sel.register(c, client.events, client)
+                        log("Client %s connected" % (client.name.decode()))
+
+                # Messages from the server operator
+                elif key.fileobj == stdin:
+                    try:
+                        data = os.read(stdin, bufsize)
+                    except BlockingIOError:
+                        continue
+                    if not data:
+                        # Keep serving the clients without a local operator
+                        sel.unregister(stdin)
+                        continue
+                    operator.feed(data)
+                    lines = list(operator)
+                    if lines:
+                        broadcast(None, b"server", lines)
+
+                # Messages from a client
+                else:
+                    client = key.data
+                    if mask & selectors.EVENT_WRITE:
+                        pending.add(client)
+                    if not mask & selectors.EVENT_READ:
+                        continue
+                    try:
+                        data = client.sock.recv(bufsize)
+                    except BlockingIOError:
+                        continue
+                    except (OSError, socket.error) as error:
+                        gone[client] = "error: %s" % (error)
+                        continue
+                    if not data:
+                        gone[client] = "disconnected"
+                        continue
+                    client.lines.feed(data)
+                    try:
+                        lines = list(client.lines)
+                    except ValueError:
+                        gone[client] = "sent a line longer than %i bytes" % (max_line)
+                        continue
+                    if lines:
+                        broadcast(client, client.name, lines)
+
+            # Flush outbound queues, only wait for writability if the socket is full
+            for client in pending:
+                if client in gone:
+                    continue
+                try:
+                    del client.outbuf[: client.sock.send(client.outbuf)]
+                except BlockingIOError:
+                    pass
+                except (OSError, socket.error) as error:
+                    gone[client] = "error: %s" % (error)
+                    continue
+                events = selectors.EVENT_READ
+                if client.outbuf:
+                    events |= selectors.EVENT_WRITE
+                if events != client.events:
+                    sel.modify(client.sock, events, client)
+                    client.events = events
+            pending.clear()
+
+            # Drop clients which have left or can't keep up
+            for client, reason in gone.items():
+                disconnect(client, reason)
+            gone.clear()
+    finally:
+        for client in list(clients):
+            client.sock.close()
+        sel.close()
+        s.close()
+        if stdin == sys.stdin.fileno():
+            os.set_blocking(stdin, True)
+        else:
+            os.close(stdin)
 
 
 # -------------------------------------------------------------------------------------------------
@@ -355,6 +1038,86 @@ def _args_check_port(value):
     return intvalue
 
 
+def _args_check_size(value):
+    """Check arguments for invalid (non-positive) sizes."""
+    intvalue = int(value)
+
+    if intvalue < 1:
+        raise argparse.ArgumentTypeError("%s is an invalid size." % value)
+    return intvalue
+
+
+def add_sockopt_args(parser, backlog, bufsize):
+    """Add socket tuning arguments to the parser, using the given defaults."""
+    group = parser.add_argument_group("socket tuning")
+    group.add_argument(
+        "--backlog",
+        metavar="NUM",
+        type=_args_check_size,
+        default=backlog,
+        required=False,
+        help="length of the listen queue (default: %i)" % (backlog),
+    )
+    group.add_argument(
+        "--bufsize",
+        metavar="BYTES",
+        type=_args_check_size,
+        default=bufsize,
+        required=False,
+        help="number of bytes to read per recv() call (default: %i)" % (bufsize),
+    )
+    group.add_argument(
+        "--rcvbuf",
+        metavar="BYTES",
+        type=_args_check_size,
+        required=False,
+        help="kernel receive buffer size SO_RCVBUF (default: system)",
+    )
+    group.add_argument(
+        "--sndbuf",
+        metavar="BYTES",
+        type=_args_check_size,
+        required=False,
+        help="kernel send buffer size SO_SNDBUF (default: system)",
+    )
+    group.add_argument(
+        "--nodelay",
+        action="store_true",
+        required=False,
+        help="disable Nagle's algorithm (TCP_NODELAY)",
+    )
+    group.add_argument(
+        "--reuseaddr",
+        action="store_true",
+        required=False,
+        help="allow binding to an address in TIME_WAIT (SO_REUSEADDR)",
+    )
+    group.add_argument(
+        "--reuseport",
+        action="store_true",
+        required=False,
+        help="allow several sockets to bind the same port (SO_REUSEPORT)",
+    )
+    group.add_argument(
+        "--keepalive",
+        action="store_true",
+        required=False,
+        help="enable TCP keepalive probes (SO_KEEPALIVE)",
+    )
+
+
+def get_sockopts(args):
+    """Return the socket tuning options from the parsed arguments as dict."""
+    return {
+        "rcvbuf": args.rcvbuf,
+        "sndbuf": args.sndbuf,
+        "nodelay": args.nodelay,
+        "reuseaddr": args.reuseaddr,
+        "reuseport": args.reuseport,
+        "keepalive": args.keepalive,
+    }
+
+
 def get_args():
     """Retrieve command line arguments."""
     parser = argparse.ArgumentParser(description="Netcat implementation in Python.")
@@ -373,6 +1136,29 @@ def get_args():
         help="send CRLF as line-endings (default: LF)",
     )
     parser.add_argument("-u", "--udp", action="store_true", required=False, help="UDP mode")
+    parser.add_argument(
+        "-F",
+        "--framing",
+        choices=sorted(Framer.DELIMITERS),
+        default="lf",
+        required=False,
+        help="how messages are delimited: lf, crlf, nul or length (4 byte big-endian prefix) "
+        "(default: lf)",
+    )
+    parser.add_argument(
+        "--chat",
+        action="store_true",
+        required=False,
+        help="chat server mode, relay lines between any number of TCP clients (requires -l)",
+    )
+    parser.add_argument(
+        "--engine",
+        choices=sorted(ENGINES),
+        default="threads",
+        required=False,
+        help="threads: one thread per direction, selectors: single-threaded event loop, "
+        "stream: binary-safe raw byte relay (default: threads)",
+    )
     parser.add_argument(
         "-v",
         "--verbose",
@@ -380,9 +1166,13 @@ def get_args():
         required=False,
         help="be verbose and print info to stderr",
     )
+    add_sockopt_args(parser, backlog=1, bufsize=1024)
     parser.add_argument("hostname", type=str, help="address to listen or connect to")
     parser.add_argument("port", type=_args_check_port, help="port to listen on or connect to")
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.chat and (not args.listen or args.udp):
+        parser.error("--chat requires --listen and can't be used with --udp")
+    return args
 
 
 # -------------------------------------------------------------------------------------------------
@@ -394,17 +1184,27 @@ def main():
     """Start the program."""
     args = get_args()
 
-    listen_backlog = 1
-    receive_buffer = 1024
-
-    if args.listen:
+    if args.chat:
+        run_chat(
+            args.hostname,
+            args.port,
+            backlog=args.backlog,
+            bufsize=args.bufsize,
+            crlf=args.crlf,
+            sockopts=get_sockopts(args),
+            verbose=args.verbose,
+        )
+    elif args.listen:
         run_server(
             args.hostname,
             args.port,
             args.udp,
-            backlog=listen_backlog,
-            bufsize=receive_buffer,
+            backlog=args.backlog,
+            bufsize=args.bufsize,
             crlf=args.crlf,
+            framing=args.framing,
+            engine=args.engine,
+            sockopts=get_sockopts(args),
             verbose=args.verbose,
         )
     else:
@@ -412,8 +1212,11 @@ def main():
             args.hostname,
             args.port,
             args.udp,
-            bufsize=receive_buffer,
+            bufsize=args.bufsize,
             crlf=args.crlf,
+            framing=args.framing,
+            engine=args.engine,
+            sockopts=get_sockopts(args),
             verbose=args.verbose,
         )
 
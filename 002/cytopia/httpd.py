@@ -2,11 +2,55 @@
 """Python multi-threaded webserver."""
 
 import argparse
+import asyncio
+import bisect
+import collections
+import email.utils
+import functools
+import gzip
+import json
+import mimetypes
+import multiprocessing
 import os
+import queue
 import re
+import signal
 import socket
+import stat
 import sys
+import tempfile
 import threading
+import time
+import urllib.parse
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# -------------------------------------------------------------------------------------------------
+# GLOBALS
+# -------------------------------------------------------------------------------------------------
+
+# Longest request or header line accepted from a client
+MAX_HEADER_LINE = 8192
+
+# Most bytes of all header lines of a request together
+MAX_HEAD_SIZE = 65536
+
+# Most header fields of a request
+MAX_HEADERS = 100
+
+# Bytes requested per read by the asyncio engine
+ASYNC_READ_SIZE = 65536
+
+# Tells the kernel more data follows (Linux only)
+MSG_MORE = getattr(socket, "MSG_MORE", 0)
 
 
 # -------------------------------------------------------------------------------------------------
@@ -30,66 +74,437 @@ def b2str(data):
         return data.decode("latin-1")
 
 
+class LineFramer:
+    """Incremental framer which splits a received byte stream into lines.
+
+    Data is appended to a single bytearray and complete lines are handed out from a read
+    cursor, so every byte is copied in and out once no matter how it was chunked. Partial
+    lines are kept until the rest of them arrives. Lines end with LF, a trailing CR is
+    stripped as well.
+    """
+
+    def __init__(self, max_size=None):
+        """Create a framer, optionally limiting the line length."""
+        self.max_size = max_size
+        self._buf = bytearray()
+        # Start of the next line
+        self._pos = 0
+        # Where to continue searching for a delimiter
+        self._scan = 0
+
+    def feed(self, data):
+        """Append received data."""
+        # Drop what has already been handed out once it is worth the copy
+        if self._pos and self._pos >= len(self._buf) // 2:
+            del self._buf[: self._pos]
+            self._scan -= self._pos
+            self._pos = 0
+        self._buf += data
+
+    def next_frame(self):
+        """Return the next complete line (without delimiter) or None if there is none yet.
+
+        Raises ValueError if the line is longer than max_size.
+        """
+        buf = self._buf
+        pos = self._pos
+
+        end = buf.find(b"\n", self._scan)
+        if end == -1:
+            # Only search the new data next time
+            self._scan = len(buf)
+            self._check_size(len(buf) - pos)
+            return None
+        self._check_size(end - pos)
+        self._pos = self._scan = end + 1
+        if end > pos and buf[end - 1] == 0x0D:
+            end -= 1
+        return bytes(buf[pos:end])
+
+    def flush(self):
+        """Return and remove all buffered data which does not form a complete line yet."""
+        data = bytes(self._buf[self._pos :])
+        self._buf = bytearray()
+        self._pos = self._scan = 0
+        return data
+
+    def _check_size(self, size):
+        """Raise ValueError if size exceeds the line length limit."""
+        if self.max_size is not None and size > self.max_size:
+            raise ValueError("Line exceeds %i bytes" % (self.max_size))
+
+
 # -------------------------------------------------------------------------------------------------
-# LOW-LEVEL COMMUNICATION FUNCTIONS
+# REQUEST PARSER
 # -------------------------------------------------------------------------------------------------
 
+# Request line: method, target and version, separated by single spaces
+REQUEST_LINE = re.compile(rb"([!#$%&'*+.^_`|~0-9A-Za-z-]+) (\S+) HTTP/([0-9])\.([0-9])")
+
+# Header field name
+HEADER_NAME = re.compile(rb"[!#$%&'*+.^_`|~0-9A-Za-z-]+")
+
+
+class RequestError(ValueError):
+    """Raised for requests which cannot be parsed, status is the code to respond with."""
+
+    def __init__(self, status):
+        """Create the error for a response status."""
+        super().__init__(REASONS[status])
+        self.status = status
+
+
+class RequestParser:
+    """Incremental parser of HTTP request heads (request line and headers) on bytes.
+
+    Received data is fed in as it arrives and lines are parsed as soon as they are
+    complete, so every byte is only looked at once no matter how slowly a request
+    trickles in. Lines are limited to MAX_HEADER_LINE bytes, the header lines to
+    MAX_HEAD_SIZE bytes in total and their number to MAX_HEADERS. Data following a request head
+    (a body or pipelined requests) stays buffered.
+    """
+
+    def __init__(self):
+        """Create a parser waiting for a request line."""
+        self.framer = LineFramer(max_size=MAX_HEADER_LINE)
+        self._reset()
 
-def send(s, data, verbose=False):
-    """Send data to a connected socket."""
-    # Ensure to terminate with desired newline
-    if isinstance(data, bytes):
-        data = b2str(data)
+    def feed(self, data):
+        """Append received data."""
+        self.framer.feed(data)
 
-    lines = data.split("\n")
+    def flush(self):
+        """Return and remove all buffered data following the last request head."""
+        return self.framer.flush()
 
-    for line in lines:
-        line += "\n"
-        size = len(line)
-        line = line.encode()
-        send = 0
+    def next_request(self):
+        """Return (verb, path, version, headers) of the next request or None if incomplete.
 
-        # Loop until all bytes have been send
-        while send < size:
+        Header names are lower-cased in the headers dict, repeated ones are joined by commas.
+        Raises RequestError if the request is malformed or exceeds the limits.
+        """
+        while True:
             try:
-                send += s.send(line)
-            except (OSError, socket.error) as error:
-                print("[Send Error] %s" % (error), file=sys.stderr)
-                print(s, file=sys.stderr)
-                s.close()
-                return
+                line = self.framer.next_frame()
+            except ValueError:
+                raise RequestError(414 if self._request is None else 431)
+            if line is None:
+                return None
+
+            if self._request is None:
+                # Ignore empty lines in front of the request line
+                if line:
+                    self._request = parse_request_line(line)
+                continue
+
+            if not line:
+                request = self._request + (self._headers,)
+                self._reset()
+                return request
+
+            self._size += len(line)
+            self._count += 1
+            if self._size > MAX_HEAD_SIZE or self._count > MAX_HEADERS:
+                raise RequestError(431)
+            name, value = parse_header_line(line)
+            if name in self._headers:
+                self._headers[name] += ", " + value
+            else:
+                self._headers[name] = value
+
+    def _reset(self):
+        """Wait for the next request line."""
+        self._request = None
+        self._headers = {}
+        self._size = 0
+        self._count = 0
+
+
+def parse_request_line(line):
+    """Extract (verb, path, version) from an HTTP request line.
+
+    Raises RequestError if it is invalid or not an HTTP/1.x request.
+    """
+    match = REQUEST_LINE.fullmatch(line)
+    if match is None:
+        raise RequestError(400)
+    verb, path, major, minor = match.groups()
+    if major != b"1":
+        raise RequestError(505)
+    vers = "1.0" if minor == b"0" else "1.1"
+    return verb.decode("ascii"), b2str(path), vers
+
+
+def parse_header_line(line):
+    """Extract the lower-cased name and the value from a header line.
+
+    Raises RequestError if it is invalid (continuation lines are rejected as well).
+    """
+    name, sep, value = line.partition(b":")
+    if not sep or HEADER_NAME.fullmatch(name) is None:
+        raise RequestError(400)
+    return name.decode("ascii").lower(), value.strip(b" \t").decode("latin-1")
 
 
-def recv(s, bufsize=1024, verbose=False):
-    """Receive data from a connected socket."""
-    data = ""
-    size = len(data)
+# -------------------------------------------------------------------------------------------------
+# REQUEST BODIES
+# -------------------------------------------------------------------------------------------------
 
-    while True:
+# Longest chunk size or trailer line accepted in chunked request bodies
+MAX_CHUNK_LINE = 4096
+
+# Interim response for clients sending "Expect: 100-continue"
+CONTINUE = b"HTTP/1.1 100 Continue\r\n\r\n"
+
+
+class BodyDecoder:
+    """Incremental decoder of request bodies sent with Content-Length or chunked.
+
+    Received data is passed to decode() as it arrives, which returns the slices of it
+    belonging to the body, so the payload is never copied. Raises RequestError if the
+    body is malformed or exceeds max_size bytes.
+    """
+
+    def __init__(self, length=None, max_size=None):
+        """Create a decoder for a body of length bytes or a chunked one if length is None."""
+        self.chunked = length is None
+        self.max_size = max_size
+        self.size = 0
+        self.done = length == 0
+        # Bytes left of the body or the current chunk
+        self._remaining = length or 0
+        self._state = "size" if self.chunked else "data"
+        self._line = bytearray()
+
+    def decode(self, data):
+        """Return (pieces, rest) of data, the body slices and what follows the body."""
+        data = memoryview(data)
+        pieces = []
+        pos = 0
+        while pos < len(data) and not self.done:
+            if self._state == "data":
+                count = min(self._remaining, len(data) - pos)
+                self.size += count
+                if self.max_size is not None and self.size > self.max_size:
+                    raise RequestError(413)
+                pieces.append(data[pos : pos + count])
+                pos += count
+                self._remaining -= count
+                if not self._remaining:
+                    self._state = "crlf"
+                    self.done = not self.chunked
+                continue
+
+            # Chunk size, the CRLF after a chunk or trailer lines
+            window = bytes(data[pos : pos + MAX_CHUNK_LINE + 2])
+            end = window.find(b"\n")
+            if end == -1:
+                self._line += window
+                pos += len(window)
+                if len(self._line) > MAX_CHUNK_LINE:
+                    raise RequestError(400)
+                continue
+            self._line += window[:end]
+            pos += end + 1
+            line = bytes(self._line).rstrip(b"\r")
+            self._line.clear()
+            self._parse_line(line)
+        return pieces, data[pos:]
+
+    def _parse_line(self, line):
+        """Advance the chunked state machine by one line."""
+        if self._state == "size":
+            try:
+                size = int(line.split(b";")[0].strip(), 16)
+            except ValueError:
+                raise RequestError(400)
+            if size < 0:
+                raise RequestError(400)
+            self._remaining = size
+            self._state = "data" if size else "trailer"
+        elif self._state == "crlf":
+            if line:
+                raise RequestError(400)
+            self._state = "size"
+        # Trailers are ignored, the body ends with an empty line
+        elif not line:
+            self.done = True
+
+
+def body_decoder(headers, max_size=None):
+    """Return a BodyDecoder for the body of a request.
+
+    Raises RequestError if the framing of the body is missing, unsupported or too large.
+    """
+    if "transfer-encoding" in headers:
+        if headers["transfer-encoding"].strip().lower() != "chunked":
+            raise RequestError(501)
+        return BodyDecoder(None, max_size)
+    length = headers.get("content-length", "").strip()
+    if not length:
+        raise RequestError(411)
+    if not length.isdigit():
+        raise RequestError(400)
+    if max_size is not None and int(length) > max_size:
+        raise RequestError(413)
+    return BodyDecoder(int(length), max_size)
+
+
+class Uploads:
+    """Stores the bodies of POST and PUT requests as files below a directory.
+
+    Bodies are written to a temporary file next to the target, which atomically replaces
+    the target once the body is complete, so readers never see partial uploads.
+
+    fsync policies:
+        none:   leave flushing to the kernel
+        file:   fsync() the file before it replaces the target
+        dir:    also fsync() the directory afterwards, so the new name is durable as well
+    """
+
+    FSYNC = ["none", "file", "dir"]
+
+    def __init__(self, directory, max_size=None, fsync="file"):
+        """Store uploads below directory, each of at most max_size bytes."""
+        self.directory = directory
+        self.max_size = max_size
+        self.fsync = fsync
+
+    def target(self, path):
+        """Return the file path for a request path or raise RequestError if it is invalid.
+
+        The path is normalized like the ones of GET requests (see normalize_path()), so an
+        upload can be requested by the same URL. Paths ending in a slash and hidden files,
+        which are not served, are rejected.
+        """
+        url = normalize_path(path)
+        if url is None or url.endswith("/"):
+            raise RequestError(403)
+        parts = url[1:].split("/")
+        if any(part.startswith(".") for part in parts):
+            raise RequestError(403)
+        return os.path.join(self.directory, *parts)
+
+    def open(self, target):
+        """Return (file, tmp path) of a new temporary file for target.
+
+        Raises RequestError 409 if target or its directory conflicts with an existing one.
+        """
+        if os.path.isdir(target):
+            raise RequestError(409)
+        directory, name = os.path.split(target)
         try:
-            data += b2str(s.recv(bufsize))
-        except socket.error as err:
-            print(err, file=sys.stderr)
-            print(s, file=sys.stderr)
-            s.close()
-            sys.exit(1)
-        if not data:
-            if verbose:
-                print("[Receive Error] Upstream connection is gone", file=sys.stderr)
-            s.close()
-            # exit the thread
-            return None
-        # Newline terminates the read request
-        if data.endswith("\n"):
-            break
-        if data.endswith("\0"):
-            break
-        # Sometimes a newline is missing at the end
-        # If this round has the same data length as previous, we're done
-        if size == len(data):
-            break
-        size = len(data)
+            fd, tmp = tempfile.mkstemp(prefix=".%s." % (name), suffix=".upload", dir=directory)
+        except (FileNotFoundError, NotADirectoryError):
+            raise RequestError(409)
+        os.fchmod(fd, 0o644)
+        return os.fdopen(fd, "wb"), tmp
+
+    def commit(self, upload, tmp, target):
+        """Replace target with a completely written upload, return True if it is new."""
+        upload.flush()
+        if self.fsync != "none":
+            os.fsync(upload.fileno())
+        upload.close()
+        created = not os.path.exists(target)
+        try:
+            os.replace(tmp, target)
+        except OSError:
+            os.unlink(tmp)
+            raise
+        if self.fsync == "dir":
+            fd = os.open(os.path.dirname(target), os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        return created
+
+    @staticmethod
+    def abort(upload, tmp):
+        """Discard an incomplete upload."""
+        upload.close()
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+
+
+def upload_response(vers, created, keep_alive=False):
+    """Build the response to a stored upload."""
+    if created:
+        return head_block(vers, 201, DEFAULT_MIME_TYPE, keep_alive) + length_field(0)
+    # 204 must not have a Content-Length
+    return head_block(vers, 204, DEFAULT_MIME_TYPE, keep_alive) + b"\r\n"
 
+
+# -------------------------------------------------------------------------------------------------
+# LOW-LEVEL COMMUNICATION FUNCTIONS
+# -------------------------------------------------------------------------------------------------
+
+
+def send(s, data, flags=0, verbose=False):
+    """Send all data to a connected socket and return False if the connection is gone."""
+    if isinstance(data, str):
+        data = data.encode()
+    try:
+        s.sendall(data, flags)
+    except (OSError, socket.error) as error:
+        print("[Send Error] %s" % (error), file=sys.stderr)
+        print(s, file=sys.stderr)
+        return False
+    return True
+
+
+def send_buffers(s, buffers, flags=0, verbose=False):
+    """Send a list of buffers like send(), but gathered by sendmsg() instead of joined.
+
+    Usually a single sendmsg() call sends all of them, the loop only continues after
+    partial sends.
+    """
+    views = [memoryview(buf) for buf in buffers if buf]
+    try:
+        while views:
+            sent = s.sendmsg(views, (), flags)
+            # Drop what has been sent
+            while sent:
+                if sent < len(views[0]):
+                    views[0] = views[0][sent:]
+                    break
+                sent -= len(views.pop(0))
+    except (OSError, socket.error) as error:
+        print("[Send Error] %s" % (error), file=sys.stderr)
+        print(s, file=sys.stderr)
+        return False
+    return True
+
+
+def respond(s, status, data, verbose=False):
+    """Send a complete response and return (status, bytes sent), the latter None on errors."""
+    if not send(s, data, verbose=verbose):
+        return status, None
+    return status, len(data)
+
+
+def recv(s, bufsize=1024, verbose=False):
+    """Receive up to bufsize bytes from a connected socket.
+
+    Returns None if the client has disconnected or timed out.
+    """
+    try:
+        data = s.recv(bufsize)
+    except socket.timeout:
+        if verbose:
+            print("[Receive Error] Idle connection timed out", file=sys.stderr)
+        return None
+    except socket.error as err:
+        print(err, file=sys.stderr)
+        print(s, file=sys.stderr)
+        return None
+    if not data:
+        if verbose:
+            print("[Receive Error] Upstream connection is gone", file=sys.stderr)
+        return None
     return data
 
 
@@ -97,90 +512,1558 @@ def recv(s, bufsize=1024, verbose=False):
 # HIGH-LEVEL REQUEST/RESPOND FUNCTIONS
 # -------------------------------------------------------------------------------------------------
 
-
-def retrieve_request(s, host, port, bufsize=1024, verbose=False):
+# Reason phrases of the status codes used by this server
+REASONS = {
+    200: "OK",
+    201: "Created",
+    204: "No Content",
+    206: "Partial Content",
+    301: "Moved Permanently",
+    304: "Not Modified",
+    400: "Bad Request",
+    403: "Forbidden",
+    404: "Not Found",
+    409: "Conflict",
+    411: "Length Required",
+    413: "Content Too Large",
+    414: "URI Too Long",
+    416: "Range Not Satisfiable",
+    431: "Request Header Fields Too Large",
+    500: "Internal Server Error",
+    501: "Not Implemented",
+    503: "Service Unavailable",
+    505: "HTTP Version Not Supported",
+}
+
+
+def retrieve_request(s, host, port, parser, bufsize=1024, verbose=False):
     """Get client request."""
-    data = recv(s, bufsize=bufsize, verbose=verbose)
-
-    # Client disconnected unexpectedly (without sending anything)
-    if data is None:
-        return
+    while True:
+        try:
+            request = parser.next_request()
+        except RequestError as error:
+            send(s, error_response("1.1", error.status), verbose=verbose)
+            return
+        if request is not None:
+            break
+        data = recv(s, bufsize=bufsize, verbose=verbose)
+        # Client disconnected unexpectedly (before the request was complete)
+        if data is None:
+            return
+        parser.feed(data)
 
-    lines = data.split("\n")
     if verbose:
-        for line in lines:
-            print("%s:%i < %s" % (host, port, line), file=sys.stderr)
+        print_request(host, port, request)
+    return request
+
+
+def print_request(host, port, request):
+    """Print a parsed request to stderr."""
+    verb, path, vers, headers = request
+    print("%s:%i < %s %s HTTP/%s" % (host, port, verb, path, vers), file=sys.stderr)
+    for name, value in headers.items():
+        print("%s:%i < %s: %s" % (host, port, name, value), file=sys.stderr)
+
 
-    # Extract HTTP Request from first line
-    regex = re.compile(r"(GET|POST|HEAD|PUT|DELETE|PATCH)\s+(.+)+\s+HTTP\/([1-2]\.[0-1])")
-    match = regex.match(lines[0])
+def wants_keep_alive(vers, headers):
+    """Return True if the client wants to keep the connection open after this request."""
+    connection = headers.get("connection", "").lower()
+    if vers == "1.0":
+        return "keep-alive" in connection
+    return "close" not in connection
 
-    # Check if request is valid
-    if match is None or len(match.groups()) != 3:
-        send(s, "HTTP/1.1 400\r\n\r\nBad Request", verbose=verbose)
-        return
 
-    verb = match.group(1)
-    path = match.group(2)
-    vers = match.group(3)
+def build_mime_types():
+    """Build the table of Content-Type header values by lower-cased file extension."""
+    mimetypes.init()
+    types = {}
+    for ext, mime in mimetypes.types_map.items():
+        if mime.startswith("text/"):
+            mime += "; charset=utf-8"
+        types[ext.lower()] = mime
+    types.update(MIME_OVERRIDES)
+    return types
 
-    return verb, path, vers
 
+# Content-Type header values which differ from what the system's mime.types says
+MIME_OVERRIDES = {
+    ".html": "text/html; charset=utf-8",
+    ".js": "text/javascript; charset=utf-8",
+    ".json": "application/json; charset=utf-8",
+    ".md": "text/markdown; charset=utf-8",
+    ".wasm": "application/wasm",
+}
 
-def respond_get(s, path, vers, verbose=False):
-    """Respond to a GET request to the client."""
-    if not os.path.isfile(path):
-        send(s, "HTTP/" + vers + " 404\r\n\r\nFile not found", verbose=verbose)
-        return
+# Content-Type of files with an unknown extension
+DEFAULT_MIME_TYPE = "text/plain; charset=utf-8"
 
+# Built once on startup
+MIME_TYPES = build_mime_types()
+
+
+def content_type(path):
+    """Return the Content-Type header value for a file."""
     ext = os.path.splitext(path)[1]
+    return MIME_TYPES.get(ext.lower(), DEFAULT_MIME_TYPE)
 
-    # Respond with 200
-    send(s, "HTTP/" + vers + " 200 OK", verbose=verbose)
 
-    # Add content-type headers
-    if ext in [".html", ".html"]:
-        send(s, "Content-Type: text/html; charset=utf-8\r\n", verbose=verbose)
-    elif ext in [".json"]:
-        send(s, "Content-Type: application/json; charset=utf-8\r\n", verbose=verbose)
-    else:
-        send(s, "Content-Type: text/plain; charset=utf-8\r\n", verbose=verbose)
+@functools.lru_cache(maxsize=None)
+def head_block(vers, status, ctype, keep_alive=False):
+    """Return the encoded status line and the headers shared by many responses.
+
+    There are only a few combinations, so each one is encoded only once.
+    """
+    return b"HTTP/%s %i %s\r\nConnection: %s\r\nContent-Type: %s\r\n" % (
+        vers.encode(),
+        status,
+        REASONS[status].encode(),
+        b"keep-alive" if keep_alive else b"close",
+        ctype.encode(),
+    )
+
+
+def length_field(length):
+    """Return the encoded Content-Length header terminating the headers of a response."""
+    return b"Content-Length: %i\r\n\r\n" % (length)
+
+
+@functools.lru_cache(maxsize=None)
+def error_response(vers, status, keep_alive=False, head=False):
+    """Build a complete response with the reason phrase as plain text body."""
+    body = REASONS[status].encode()
+    data = head_block(vers, status, DEFAULT_MIME_TYPE, keep_alive) + length_field(len(body))
+    return data if head else data + body
+
+
+def respond_get(
+    s,
+    path,
+    vers,
+    headers,
+    keep_alive=False,
+    head=False,
+    cache=None,
+    compressed=None,
+    sidecars=None,
+    verbose=False,
+):
+    """Respond to a GET (or HEAD) request of a file and return (status, bytes sent).
+
+    sidecars maps encodings to precompressed variants of the file. The bytes sent are None
+    if the client is gone.
+    """
+    try:
+        info, body, content = open_body(path, cache)
+    except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+        return respond(s, 404, error_response(vers, 404, keep_alive, head), verbose=verbose)
+
+    try:
+        variant = encoded_variant(path, info, body, content, headers, compressed, sidecars, cache)
+        if callable(variant):
+            variant = variant()
+        if variant is not None:
+            if content is not None:
+                content.close()
+            info, body, content = variant
+        status, parts = get_response(vers, info, headers, keep_alive, head)
+        if not send_parts(s, parts, body=body, content=content, verbose=verbose):
+            return status, None
+        return status, parts_size(parts)
+    finally:
+        if content is not None:
+            content.close()
+
+
+def open_body(path, cache=None):
+    """Return (info, body, content) of a file, either with its body in memory or opened.
+
+    Hot files are taken from the cache, otherwise body is None and the open file content
+    has to be closed by the caller.
+    """
+    entry = None if cache is None else cache.get(path)
+    if entry is not None:
+        info, body = entry
+        return info, body, None
+
+    content = open(path, "rb")
+    try:
+        info = file_info(path, os.fstat(content.fileno()))
+    except OSError:
+        content.close()
+        raise
+    return info, None, content
+
+
+def send_parts(s, parts, body=None, content=None, verbose=False):
+    """Send a response made of buffers and (offset, count) slices of the body.
+
+    The slices are taken from body if it is in memory, otherwise they are sent from the
+    open file content. Buffers are gathered until a slice has to be sent from the file.
+    """
+    buffers = []
+    for part in parts:
+        if isinstance(part, bytes):
+            buffers.append(part)
+        elif body is not None:
+            offset, count = part
+            buffers.append(memoryview(body)[offset : offset + count])
+        else:
+            # Let the kernel put the headers into the same packet as the start of the body
+            if not send_buffers(s, buffers, flags=MSG_MORE, verbose=verbose):
+                return False
+            buffers = []
+            if not send_file(s, content, *part, verbose=verbose):
+                return False
+    return send_buffers(s, buffers, verbose=verbose)
+
+
+def send_file(s, content, offset, count, verbose=False):
+    """Send count bytes from offset of an open file via sendfile(), False if that failed.
+
+    The body is copied by the kernel without passing through user space, so memory usage
+    does not depend on the file size. Python falls back to read()/send() in chunks where
+    sendfile() is unavailable.
+    """
+    try:
+        sent = s.sendfile(content, offset, count)
+    except (OSError, socket.error) as error:
+        print("[Send Error] %s" % (error), file=sys.stderr)
+        print(s, file=sys.stderr)
+        return False
+    # The file has been truncated meanwhile, the client waits for the missing bytes in vain
+    if sent != count:
+        print("[Send Error] %s changed while sending it" % (content.name), file=sys.stderr)
+        return False
+    return True
+
+
+def respond_unavailable(s, verbose=False):
+    """Turn a client away because the server is overloaded and close the connection."""
+    body = REASONS[503].encode()
+    buffers = [head_block("1.1", 503, DEFAULT_MIME_TYPE), b"Retry-After: 1\r\n"]
+    send_buffers(s, buffers + [length_field(len(body)), body], verbose=verbose)
+    s.close()
+
+
+def respond_upload(
+    s,
+    parser,
+    path,
+    vers,
+    headers,
+    keep_alive,
+    uploads,
+    bufsize=1024,
+    cache=None,
+    docs=None,
+    verbose=False,
+):
+    """Store the body of a POST or PUT request and return (status, bytes sent).
+
+    The bytes sent are None if the client is gone. Error responses close the connection,
+    as the rest of the body has not been read. The body is received in place into a
+    buffer which is reused for every chunk and written to the file right away, so uploads
+    of any size take constant memory.
+    """
+    try:
+        decoder = body_decoder(headers, uploads.max_size)
+        target = uploads.target(path)
+        upload, tmp = uploads.open(target)
+    except RequestError as error:
+        return respond(s, error.status, error_response(vers, error.status), verbose=verbose)
+
+    if headers.get("expect", "").lower() == "100-continue" and not send(s, CONTINUE):
+        uploads.abort(upload, tmp)
+        return 400, None
+
+    buf = bytearray(bufsize)
+    view = memoryview(buf)
+    # Whatever arrived along with the request head
+    data = parser.flush()
+    try:
+        while True:
+            pieces, rest = decoder.decode(data)
+            for piece in pieces:
+                upload.write(piece)
+            if decoder.done:
+                break
+            try:
+                size = s.recv_into(buf)
+            except socket.timeout:
+                size = 0
+            if not size:
+                if verbose:
+                    print("[Receive Error] Upload is incomplete", file=sys.stderr)
+                uploads.abort(upload, tmp)
+                return 400, None
+            data = view[:size]
+        # Pipelined requests
+        parser.feed(rest)
+        created = uploads.commit(upload, tmp, target)
+    except RequestError as error:
+        uploads.abort(upload, tmp)
+        return respond(s, error.status, error_response(vers, error.status), verbose=verbose)
+    except OSError as error:
+        print("[Upload Error] %s" % (error), file=sys.stderr)
+        uploads.abort(upload, tmp)
+        return respond(s, 500, error_response(vers, 500), verbose=verbose)
+
+    if cache is not None:
+        cache.discard(target)
+    if docs is not None:
+        docs.add(target)
+    data = upload_response(vers, created, keep_alive)
+    return respond(s, 201 if created else 204, data, verbose=verbose)
+
+
+# -------------------------------------------------------------------------------------------------
+# CONDITIONAL AND RANGE REQUESTS
+# -------------------------------------------------------------------------------------------------
+
+# Most ranges accepted in a single Range header, more are answered with the full body
+MAX_RANGES = 16
+
+# Separates the parts of multi-range responses
+BOUNDARY = os.urandom(8).hex()
+
+# What is known about a file to respond to GET requests, fields are its encoded validators
+FileInfo = collections.namedtuple("FileInfo", ["ctype", "size", "mtime", "etag", "fields"])
+
+
+def file_info(path, st):
+    """Return the FileInfo of a file from its os.stat() result."""
+    return _file_info(path, st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+@functools.lru_cache(maxsize=4096)
+def _file_info(path, ino, size, mtime_ns):
+    """Build the FileInfo of a file, each version of a file is only built once."""
+    mtime = mtime_ns // 1000000000
+    etag = '"%x-%x"' % (mtime_ns, size)
+    fields = "Accept-Ranges: bytes\r\nETag: %s\r\nLast-Modified: %s\r\nVary: %s\r\n" % (
+        etag,
+        email.utils.formatdate(mtime, usegmt=True),
+        "Accept-Encoding",
+    )
+    return FileInfo(content_type(path), size, mtime, etag, fields.encode())
+
+
+def parse_http_date(value):
+    """Return an HTTP date as unix timestamp or None if it is invalid."""
+    try:
+        return email.utils.parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def not_modified(info, headers):
+    """Return True if the validators of the request match the file (If-None-Match wins)."""
+    if "if-none-match" in headers:
+        tags = [tag.strip() for tag in headers["if-none-match"].split(",")]
+        # Weak comparison
+        return "*" in tags or any(tag.replace("W/", "", 1) == info.etag for tag in tags)
+    if "if-modified-since" in headers:
+        since = parse_http_date(headers["if-modified-since"])
+        return since is not None and info.mtime <= since
+    return False
+
+
+def parse_ranges(value, size):
+    """Parse a Range header into a list of (offset, count) of a body of size bytes.
+
+    Returns None if the header is invalid and should be ignored and an empty list if none
+    of the ranges can be satisfied.
+    """
+    unit, _, ranges = value.partition("=")
+    if unit.strip() != "bytes":
+        return None
+    ranges = ranges.split(",")
+    if len(ranges) > MAX_RANGES:
+        return None
+
+    result = []
+    for spec in ranges:
+        first, sep, last = spec.strip().partition("-")
+        if not sep or not (first + last).isdigit():
+            return None
+        if not first:
+            # Suffix range of the last bytes
+            count = min(int(last), size)
+            if count:
+                result.append((size - count, count))
+            continue
+        first = int(first)
+        if last and int(last) < first:
+            return None
+        last = min(int(last), size - 1) if last else size - 1
+        if first < size:
+            result.append((first, last - first + 1))
+    return result
+
+
+def get_response(vers, info, headers, keep_alive=False, head=False):
+    """Build the response to a GET (or HEAD) request of a file.
+
+    Returns the status and a list of encoded header and body parts along with
+    (offset, count) tuples for slices of the file to send.
+    """
+    if not_modified(info, headers):
+        return 304, [head_block(vers, 304, info.ctype, keep_alive), info.fields, b"\r\n"]
+
+    ranges = None
+    if "range" in headers and not head and fresh_range(info, headers):
+        ranges = parse_ranges(headers["range"], info.size)
+
+    # Unsatisfiable
+    if ranges == []:
+        body = REASONS[416].encode()
+        return 416, [
+            head_block(vers, 416, DEFAULT_MIME_TYPE, keep_alive),
+            b"Content-Range: bytes */%i\r\n" % (info.size),
+            length_field(len(body)),
+            body,
+        ]
+
+    # Full body
+    if ranges is None:
+        parts = [head_block(vers, 200, info.ctype, keep_alive), info.fields]
+        parts.append(length_field(info.size))
+        if not head and info.size:
+            parts.append((0, info.size))
+        return 200, parts
+
+    # Single range
+    if len(ranges) == 1:
+        offset, count = ranges[0]
+        return 206, [
+            head_block(vers, 206, info.ctype, keep_alive),
+            info.fields,
+            content_range(offset, count, info.size),
+            length_field(count),
+            ranges[0],
+        ]
+
+    # Multiple ranges
+    body = []
+    for offset, count in ranges:
+        body.append(
+            b"\r\n--%s\r\nContent-Type: %s\r\n%s\r\n"
+            % (BOUNDARY.encode(), info.ctype.encode(), content_range(offset, count, info.size))
+        )
+        body.append((offset, count))
+    body.append(b"\r\n--%s--\r\n" % (BOUNDARY.encode()))
+    ctype = "multipart/byteranges; boundary=%s" % (BOUNDARY)
+    parts = [head_block(vers, 206, ctype, keep_alive), info.fields, length_field(parts_size(body))]
+    return 206, parts + body
+
+
+def parts_size(parts):
+    """Return the number of bytes of a response made of buffers and (offset, count) slices."""
+    return sum(len(part) if isinstance(part, bytes) else part[1] for part in parts)
+
+
+def fresh_range(info, headers):
+    """Return True unless If-Range says the client's copy of the file is outdated."""
+    if "if-range" not in headers:
+        return True
+    value = headers["if-range"].strip()
+    if value.startswith('"'):
+        return value == info.etag
+    return parse_http_date(value) == info.mtime
 
-    # Serve the content
-    with open(path) as content:
-        line = content.read()
-        print(line)
-        send(s, line, verbose=verbose)
+
+def content_range(offset, count, size):
+    """Return the encoded Content-Range header of a slice of the body."""
+    return b"Content-Range: bytes %i-%i/%i\r\n" % (offset, offset + count - 1, size)
 
 
 # -------------------------------------------------------------------------------------------------
-# THREADED REQUEST SERVING
+# CONTENT ENCODING
 # -------------------------------------------------------------------------------------------------
 
+# Content codings in order of preference with the extension of their precompressed
+# sidecar files and a function compressing a body on the fly (None if unavailable)
+ENCODINGS = [
+    ("br", ".br", None if brotli is None else functools.partial(brotli.compress, quality=5)),
+    ("zstd", ".zst", None if zstandard is None else zstandard.ZstdCompressor(level=3).compress),
+    ("gzip", ".gz", functools.partial(gzip.compress, compresslevel=6, mtime=0)),
+]
+
+# Smaller bodies do not get smaller enough to be worth compressing
+MIN_COMPRESS_SIZE = 256
+
+# Content types which are compressed on the fly next to text/*
+COMPRESSIBLE_TYPES = {
+    "application/javascript",
+    "application/json",
+    "application/wasm",
+    "application/xml",
+    "image/svg+xml",
+}
+
+
+def accepted_encodings(headers):
+    """Return the encodings of ENCODINGS the client accepts, in order of preference."""
+    accepted = {}
+    for item in headers.get("accept-encoding", "").split(","):
+        name, _, params = item.partition(";")
+        qvalue = 1.0
+        param, _, value = params.partition("=")
+        if param.strip() == "q":
+            try:
+                qvalue = float(value)
+            except ValueError:
+                qvalue = 0.0
+        accepted[name.strip().lower()] = qvalue
 
-def serve(s, host, port, docroot, index, bufsize=1024, verbose=False):
-    """Threaded function to serve HTTP requests. One call per client."""
-    request = retrieve_request(s, host, port, bufsize=bufsize, verbose=verbose)
-    if request is None:
-        s.close()
-        return
+    wildcard = accepted.get("*", 0.0)
+    return [enc for enc in ENCODINGS if accepted.get(enc[0], wildcard) > 0]
 
-    # Split request
-    verb, path, vers = request
 
-    # Build filesystem path from document root and request path
-    path = "%s/%s" % (docroot, index) if path == "/" else "%s/%s" % (docroot, path)
+def compressible(info):
+    """Return True if the body of a file is worth compressing on the fly."""
+    ctype = info.ctype.split(";")[0]
+    return info.size >= MIN_COMPRESS_SIZE and (
+        ctype.startswith("text/") or ctype in COMPRESSIBLE_TYPES
+    )
 
-    if verb == "GET":
-        respond_get(s, path, vers, verbose)
-    elif verb == "HEAD":
-        send(s, "HTTP/" + vers + " 200 OK\r\n", verbose=verbose)
-    else:
-        # TODO: Other HTTP verbs are not yet implemented
-        send(s, "HTTP/" + vers + " 501\r\n\r\nNot implemented", verbose=verbose)
+
+@functools.lru_cache(maxsize=4096)
+def variant_info(info, encoding, size):
+    """Build the FileInfo of a file's body in a content coding of size bytes."""
+    etag = '%s-%s"' % (info.etag[:-1], encoding)
+    fields = info.fields.replace(info.etag.encode(), etag.encode())
+    fields += b"Content-Encoding: %s\r\n" % (encoding.encode())
+    return info._replace(size=size, etag=etag, fields=fields)
+
+
+def encoded_variant(path, info, body, content, headers, compressed=None, sidecars=None, cache=None):
+    """Return (info, body, content) of the best encoded variant the client accepts or None.
+
+    Precompressed sidecar files (e.g. index.html.gz) next to the file are served as they are,
+    provided they are not older than the file. sidecars maps encodings to the sidecar files
+    of the file (see DocrootIndex), so no other paths are looked up on disk, and they are
+    opened through the file cache. Otherwise the body is compressed on the fly if compressed
+    (a CompressedCache) is given and the file is small enough for it. If the compressed body
+    is not cached yet, a function compressing it and returning the variant is returned
+    instead, so that event loops can run it in a thread.
+    """
+    encodings = accepted_encodings(headers)
+    if not encodings:
+        return None
+
+    for encoding, _, _ in encodings if sidecars else []:
+        if encoding not in sidecars:
+            continue
+        try:
+            variant, variant_body, variant_content = open_body(sidecars[encoding], cache)
+        except OSError:
+            continue
+        if variant.mtime >= info.mtime:
+            return variant_info(info, encoding, variant.size), variant_body, variant_content
+        if variant_content is not None:
+            variant_content.close()
+
+    if compressed is None or not compressible(info) or info.size > compressed.max_file:
+        return None
+    for encoding, _, compress in encodings:
+        if compress is None:
+            continue
+        # Files are identified by their ETag, which changes along with them
+        key = (path, info.etag, encoding)
+        data = compressed.get(key)
+        if data is None:
+            return functools.partial(
+                compress_variant, info, body, content, key, compress, compressed
+            )
+        return variant_info(info, encoding, len(data)), data, None
+    return None
+
+
+def compress_variant(info, body, content, key, compress, compressed):
+    """Compress the body of a file, store it in compressed and return its variant."""
+    if body is None:
+        body = os.pread(content.fileno(), info.size, 0)
+    data = compressed.put(key, compress(body))
+    return variant_info(info, key[2], len(data)), data, None
+
+
+class CompressedCache:
+    """Byte-budgeted LRU cache of bodies compressed on the fly.
+
+    Entries are keyed by (path, ETag, encoding), so a changed file is compressed anew
+    while its outdated variants are evicted eventually. Safe to be shared between threads.
+    """
+
+    def __init__(self, max_bytes, max_file=None):
+        """Cache up to max_bytes of compressed bodies of files of at most max_file bytes."""
+        self.max_bytes = max_bytes
+        self.max_file = max_bytes // 4 if max_file is None else max_file
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Return the compressed body stored under key or None."""
+        with self.lock:
+            data = self.entries.get(key)
+            if data is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return data
+
+    def put(self, key, data):
+        """Store a compressed body under key, evicting the least recently used ones if needed."""
+        with self.lock:
+            if key in self.entries:
+                self.size -= len(self.entries.pop(key))
+            self.entries[key] = data
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                self.size -= len(self.entries.popitem(last=False)[1])
+                self.evictions += 1
+        return data
+
+    def stats(self):
+        """Return the cache counters as dict."""
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+# -------------------------------------------------------------------------------------------------
+# FILE CACHE
+# -------------------------------------------------------------------------------------------------
+
+# Seconds a cached file is served without checking whether it has changed on disk
+CACHE_REVALIDATE = 1.0
+
+
+class FileCache:
+    """Byte-budgeted LRU cache of file bodies along with their FileInfo.
+
+    Entries are keyed by path and dropped once the file's mtime, size or inode differs
+    from the cached one. Within CACHE_REVALIDATE seconds of the last check a hit is
+    served without touching the filesystem. Safe to be shared between threads.
+    """
+
+    def __init__(self, max_bytes, max_file=None):
+        """Cache up to max_bytes of bodies, each file being at most max_file bytes."""
+        self.max_bytes = max_bytes
+        self.max_file = max_bytes // 4 if max_file is None else max_file
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # path => [(info, body), (st_ino, st_size, st_mtime_ns), last check]
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, path):
+        """Return (info, body) of a file or None if it cannot be served from the cache."""
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None and now - entry[2] < CACHE_REVALIDATE:
+                self.entries.move_to_end(path)
+                self.hits += 1
+                return entry[0]
+
+        try:
+            st = os.stat(path)
+        except OSError:
+            st = None
+        identity = None if st is None else (st.st_ino, st.st_size, st.st_mtime_ns)
+
+        with self.lock:
+            if entry is not None and self.entries.get(path) is entry:
+                if entry[1] == identity:
+                    entry[2] = now
+                    self.entries.move_to_end(path)
+                    self.hits += 1
+                    return entry[0]
+                self._remove(path)
+            self.misses += 1
+
+        if identity is None or not stat.S_ISREG(st.st_mode) or st.st_size > self.max_file:
+            return None
+        return self._load(path, now)
+
+    def discard(self, path):
+        """Drop the entry of a file which is known to have changed."""
+        with self.lock:
+            if path in self.entries:
+                self._remove(path)
+
+    def stats(self):
+        """Return the cache counters as dict."""
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def _load(self, path, now):
+        """Read a file into the cache, evicting the least recently used ones if needed."""
+        try:
+            with open(path, "rb") as content:
+                st = os.fstat(content.fileno())
+                body = content.read(self.max_file + 1)
+        except OSError:
+            return None
+        # Changed in the meantime, serve it uncached this time
+        if len(body) != st.st_size or len(body) > self.max_file:
+            return None
+
+        value = (file_info(path, st), body)
+        with self.lock:
+            if path in self.entries:
+                self._remove(path)
+            self.entries[path] = [value, (st.st_ino, st.st_size, st.st_mtime_ns), now]
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+        return value
+
+    def _remove(self, path):
+        """Drop an entry, the lock must be held."""
+        self.size -= len(self.entries.pop(path)[0][1])
+
+
+def print_cache_stats(cache=None, compressed=None):
+    """Print the counters of the file cache and the compressed cache to stderr."""
+    for label, obj in [("Cache:     ", cache), ("Compressed:", compressed)]:
+        if obj is not None:
+            stats = obj.stats()
+            stats["label"] = label
+            print(
+                "%(label)s %(entries)i entries, %(bytes)i bytes, %(hits)i hits, "
+                "%(misses)i misses, %(evictions)i evictions" % stats,
+                file=sys.stderr,
+            )
+
+
+# -------------------------------------------------------------------------------------------------
+# DOCROOT INDEX
+# -------------------------------------------------------------------------------------------------
+
+
+def normalize_path(path):
+    """Return the normalized (unquoted, without query) URL path or None if it escapes the root.
+
+    A trailing slash is kept, as it tells directories apart.
+    """
+    path = urllib.parse.unquote(path.split("?", 1)[0].split("#", 1)[0])
+    parts = []
+    for part in path.split("/"):
+        if part == "..":
+            return None
+        if part and part != ".":
+            parts.append(part)
+    if "\0" in path:
+        return None
+    trailing = "/" if path.endswith("/") and parts else ""
+    return "/" + "/".join(parts) + trailing
+
+
+class DocrootIndex:
+    """Index of all files below the docroot by their normalized URL path.
+
+    The docroot is scanned on startup and then rescanned every rescan seconds (if not 0)
+    by a background thread, which swaps in a complete new index, so files are resolved by
+    a dict lookup without any syscall. Directories are served by their index file. Paths
+    escaping the docroot are rejected before any lookup and hidden files (dot files) are
+    not served. Precompressed sidecar files (see ENCODINGS) are linked to their file, so
+    requests for files without them never look for them on disk.
+    """
+
+    def __init__(self, docroot, index="index.html", rescan=0):
+        """Scan the docroot."""
+        self.docroot = docroot
+        self.index = index
+        self.rescan = rescan
+        # URL path => (file path, FileInfo)
+        self.files = {}
+        # URL paths of directories without trailing slash ("" is the docroot)
+        self.dirs = set()
+        # File path => {encoding: file path of its sidecar}
+        self.sidecars = {}
+        self.scan()
+
+    def scan(self):
+        """Build a new index of the docroot and swap it in."""
+        files = {}
+        dirs = {""}
+        for top, subdirs, names in os.walk(self.docroot):
+            subdirs[:] = [name for name in subdirs if not name.startswith(".")]
+            url = "/" + os.path.relpath(top, self.docroot).replace(os.sep, "/")
+            url = "" if url == "/." else url
+            dirs.update(url + "/" + name for name in subdirs)
+            for name in names:
+                if not name.startswith("."):
+                    self._add(files, url + "/" + name, os.path.join(top, name))
+        sidecars = {}
+        for url in files:
+            self._link(files, sidecars, url)
+        self.files, self.dirs, self.sidecars = files, dirs, sidecars
+
+    def add(self, path):
+        """Add or update a single file of the docroot (e.g. after it has been uploaded)."""
+        rel = os.path.relpath(path, self.docroot)
+        if rel.startswith(os.pardir):
+            return
+        url = "/" + rel.replace(os.sep, "/")
+        self._add(self.files, url, path)
+        # It may be a sidecar or have sidecars itself
+        self._link(self.files, self.sidecars, url)
+        for _, ext, _ in ENCODINGS:
+            self._link(self.files, self.sidecars, url + ext)
+
+    def resolve(self, path):
+        """Resolve a request path into (status, value).
+
+        The value is the file path for 200 and the location to redirect to for 301
+        (directories requested without trailing slash), None for 403 and 404.
+        """
+        url = normalize_path(path)
+        if url is None:
+            return 403, None
+        if url.endswith("/"):
+            url += self.index
+        entry = self.files.get(url)
+        if entry is not None:
+            return 200, entry[0]
+        if url in self.dirs:
+            return 301, urllib.parse.quote(url) + "/"
+        return 404, None
+
+    def start(self):
+        """Start rescanning the docroot in the background if a rescan interval is set."""
+        if self.rescan:
+            t = threading.Thread(target=self._watch)
+            t.daemon = True
+            t.start()
+
+    def _watch(self):
+        """Rescan the docroot endlessly."""
+        while True:
+            time.sleep(self.rescan)
+            try:
+                self.scan()
+            except OSError as error:
+                print("[Scan Error] %s" % (error), file=sys.stderr)
+
+    @staticmethod
+    def _add(files, url, path):
+        """Add a regular file to files, which also precomputes its FileInfo."""
+        try:
+            st = os.stat(path)
+        except OSError:
+            return
+        if stat.S_ISREG(st.st_mode):
+            files[url] = (path, file_info(path, st))
+
+    @staticmethod
+    def _link(files, sidecars, url):
+        """Link the file of url to the file it is a precompressed sidecar of, if any."""
+        if url not in files:
+            return
+        for encoding, ext, _ in ENCODINGS:
+            if url.endswith(ext) and url[: -len(ext)] in files:
+                base = files[url[: -len(ext)]][0]
+                sidecars.setdefault(base, {})[encoding] = files[url][0]
+
+
+def redirect_response(vers, location, keep_alive=False):
+    """Build a response redirecting permanently to location."""
+    body = REASONS[301].encode()
+    return (
+        head_block(vers, 301, DEFAULT_MIME_TYPE, keep_alive)
+        + b"Location: %s\r\n" % (location.encode())
+        + length_field(len(body))
+        + body
+    )
+
+
+# -------------------------------------------------------------------------------------------------
+# ACCESS LOG AND METRICS
+# -------------------------------------------------------------------------------------------------
+
+# Upper bounds in seconds of the request duration histogram buckets
+LATENCY_BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 10]
+
+# Content-Type of the Prometheus text exposition format
+METRICS_MIME_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Most log entries written at once by the access log thread
+LOG_BATCH = 1024
+
+
+class Metrics:
+    """Request counters, latency histogram and in-flight gauge in shared memory.
+
+    The values live in an array of doubles which is created before the workers are
+    forked, so every worker process counts into the same numbers and any of them can
+    render them in the Prometheus text format for the metrics path.
+    """
+
+    def __init__(self, path):
+        """Allocate the shared counters."""
+        self.path = path
+        self.codes = sorted(REASONS)
+        # in flight, bytes sent, duration sum, buckets (+Inf last), one counter per status
+        self.slot_bucket = 3
+        self.slot_code = self.slot_bucket + len(LATENCY_BUCKETS) + 1
+        self.values = multiprocessing.RawArray("d", self.slot_code + len(self.codes))
+        self.lock = multiprocessing.Lock()
+
+    def begin(self):
+        """Count a request which is about to be served."""
+        with self.lock:
+            self.values[0] += 1
+
+    def end(self, status, sent, duration):
+        """Count a request which has been served."""
+        bucket = self.slot_bucket + bisect.bisect_left(LATENCY_BUCKETS, duration)
+        code = self.slot_code + self.codes.index(status)
+        with self.lock:
+            self.values[0] -= 1
+            self.values[1] += sent or 0
+            self.values[2] += duration
+            self.values[bucket] += 1
+            self.values[code] += 1
+
+    def render(self):
+        """Return the metrics in the Prometheus text exposition format."""
+        with self.lock:
+            values = self.values[:]
+        buckets = values[self.slot_bucket : self.slot_code]
+        lines = [
+            "# HELP httpd_requests_total Requests served by status code.",
+            "# TYPE httpd_requests_total counter",
+        ]
+        for code, count in zip(self.codes, values[self.slot_code :]):
+            lines.append('httpd_requests_total{code="%i"} %i' % (code, count))
+        lines += [
+            "# HELP httpd_request_duration_seconds Time from parsed request to sent response.",
+            "# TYPE httpd_request_duration_seconds histogram",
+        ]
+        total = 0
+        for bound, count in zip(LATENCY_BUCKETS + ["+Inf"], buckets):
+            total += count
+            lines.append('httpd_request_duration_seconds_bucket{le="%s"} %i' % (bound, total))
+        lines += [
+            "httpd_request_duration_seconds_sum %.6f" % (values[2]),
+            "httpd_request_duration_seconds_count %i" % (total),
+            "# HELP httpd_sent_bytes_total Bytes of responses sent, headers included.",
+            "# TYPE httpd_sent_bytes_total counter",
+            "httpd_sent_bytes_total %i" % (values[1]),
+            "# HELP httpd_requests_in_flight Requests currently being served.",
+            "# TYPE httpd_requests_in_flight gauge",
+            "httpd_requests_in_flight %i" % (values[0]),
+        ]
+        return ("\n".join(lines) + "\n").encode()
+
+
+def metrics_response(vers, metrics, keep_alive=False, head=False):
+    """Build a response with the current metrics."""
+    body = metrics.render()
+    data = head_block(vers, 200, METRICS_MIME_TYPE, keep_alive) + length_field(len(body))
+    return data if head else data + body
+
+
+class AccessLog:
+    """Access log in Common Log Format or as JSON lines, written by a background thread.
+
+    Serving a request only queues a tuple of its raw values. The thread formats the
+    entries and writes whatever has piled up with a single write() call. If the log
+    cannot keep up and the queue is full, entries are dropped and counted instead of
+    slowing down the clients. Every worker process appends to the file on its own.
+    """
+
+    FORMATS = ["common", "json"]
+
+    def __init__(self, path, fmt="common", queue_size=65536):
+        """Log to the file path ("-" for stdout) in the format fmt."""
+        self.path = path
+        self.fmt = fmt
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.dropped = 0
+        self.thread = None
+
+    def log(self, host, request, status, sent, duration):
+        """Queue a log entry for a served request."""
+        try:
+            self.queue.put_nowait((time.time(), host, request, status, sent, duration))
+        except queue.Full:
+            self.dropped += 1
+
+    def start(self):
+        """Open the log file and start the writing thread."""
+        if self.path == "-":
+            fd = sys.stdout.fileno()
+        else:
+            try:
+                fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            except OSError as error:
+                print("[Log Error] %s" % (error), file=sys.stderr)
+                sys.exit(1)
+        self.thread = threading.Thread(target=self._write, args=(fd,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        """Write all queued entries and stop the writing thread."""
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        if self.dropped:
+            print("[Log Error] %i entries dropped" % (self.dropped), file=sys.stderr)
+
+    def _write(self, fd):
+        """Write batches of queued entries until told to stop."""
+        stopping = False
+        while not stopping:
+            entries = [self.queue.get()]
+            while len(entries) < LOG_BATCH:
+                try:
+                    entries.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in entries:
+                stopping = True
+                entries = [entry for entry in entries if entry is not None]
+            data = "".join(self._format(*entry) for entry in entries).encode()
+            try:
+                while data:
+                    data = data[os.write(fd, data) :]
+            except OSError as error:
+                print("[Log Error] %s" % (error), file=sys.stderr)
+        if fd != sys.stdout.fileno():
+            os.close(fd)
+
+    def _format(self, when, host, request, status, sent, duration):
+        """Return a single log line."""
+        verb, path, vers, headers = request
+        if self.fmt == "json":
+            entry = {
+                "time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(when)),
+                "host": host,
+                "method": verb,
+                "path": path,
+                "protocol": "HTTP/%s" % (vers),
+                "status": status,
+                "bytes": sent or 0,
+                "duration": round(duration, 6),
+                "referer": headers.get("referer"),
+                "user_agent": headers.get("user-agent"),
+            }
+            return json.dumps(entry) + "\n"
+        return '%s - - [%s] "%s %s HTTP/%s" %i %s\n' % (
+            host,
+            time.strftime("%d/%b/%Y:%H:%M:%S +0000", time.gmtime(when)),
+            verb,
+            path,
+            vers,
+            status,
+            sent or "-",
+        )
+
+
+# -------------------------------------------------------------------------------------------------
+# THREADED REQUEST SERVING
+# -------------------------------------------------------------------------------------------------
+
+
+def serve(
+    s,
+    host,
+    port,
+    docs,
+    bufsize=1024,
+    timeout=5,
+    max_requests=100,
+    cache=None,
+    compressed=None,
+    uploads=None,
+    metrics=None,
+    access_log=None,
+    verbose=False,
+):
+    """Threaded function to serve HTTP requests. One call per client.
+
+    The connection is kept open for further (also pipelined) requests until the client
+    closes it, it has been idle for timeout seconds or max_requests have been served.
+    """
+    # Partial or pipelined requests are carried over from one request to the next
+    parser = RequestParser()
+    s.settimeout(timeout)
+
+    for num in range(1, max_requests + 1):
+        request = retrieve_request(s, host, port, parser, bufsize=bufsize, verbose=verbose)
+        if request is None:
+            break
+
+        # Split request
+        verb, path, vers, headers = request
+        keep_alive = num < max_requests and wants_keep_alive(vers, headers)
+
+        start = time.monotonic()
+        if metrics is not None:
+            metrics.begin()
+        status, sent = 500, None
+        try:
+            if verb in ["GET", "HEAD"]:
+                head = verb == "HEAD"
+                if metrics is not None and path.split("?", 1)[0] == metrics.path:
+                    data = metrics_response(vers, metrics, keep_alive, head)
+                    status, sent = respond(s, 200, data, verbose=verbose)
+                else:
+                    status, path = docs.resolve(path)
+                    if status == 200:
+                        status, sent = respond_get(
+                            s,
+                            path,
+                            vers,
+                            headers,
+                            keep_alive,
+                            head,
+                            cache,
+                            compressed,
+                            docs.sidecars.get(path),
+                            verbose,
+                        )
+                    elif status == 301:
+                        data = redirect_response(vers, path, keep_alive)
+                        status, sent = respond(s, status, data, verbose=verbose)
+                    else:
+                        data = error_response(vers, status, keep_alive, head)
+                        status, sent = respond(s, status, data, verbose=verbose)
+            elif verb in ["POST", "PUT"] and uploads is not None:
+                status, sent = respond_upload(
+                    s,
+                    parser,
+                    path,
+                    vers,
+                    headers,
+                    keep_alive,
+                    uploads,
+                    bufsize,
+                    cache,
+                    docs,
+                    verbose=verbose,
+                )
+                # The rest of the body has not been read after errors
+                keep_alive = keep_alive and status < 400
+            else:
+                # Other verbs, and POST/PUT without -u, get a 501 and their body is not read
+                keep_alive = False
+                status, sent = respond(s, 501, error_response(vers, 501), verbose=verbose)
+        finally:
+            duration = time.monotonic() - start
+            if metrics is not None:
+                metrics.end(status, sent, duration)
+            if access_log is not None:
+                access_log.log(host, request, status, sent, duration)
+
+        if sent is None or not keep_alive:
+            break
 
     s.close()
-    return
+
+
+# -------------------------------------------------------------------------------------------------
+# ASYNCIO REQUEST SERVING
+# -------------------------------------------------------------------------------------------------
+
+
+async def retrieve_request_async(reader, writer, host, port, parser, timeout=5, verbose=False):
+    """Get client request from an asyncio stream."""
+    while True:
+        try:
+            request = parser.next_request()
+        except RequestError as error:
+            writer.write(error_response("1.1", error.status))
+            return
+        if request is not None:
+            break
+        try:
+            data = await asyncio.wait_for(reader.read(ASYNC_READ_SIZE), timeout)
+        except asyncio.TimeoutError:
+            if verbose:
+                print("[Receive Error] Idle connection timed out", file=sys.stderr)
+            return
+        except ConnectionError:
+            data = None
+        if not data:
+            # Client disconnected unexpectedly (before the request was complete)
+            if verbose:
+                print("[Receive Error] Upstream connection is gone", file=sys.stderr)
+            return
+        parser.feed(data)
+
+    if verbose:
+        print_request(host, port, request)
+    return request
+
+
+async def respond_get_async(
+    writer,
+    path,
+    vers,
+    headers,
+    keep_alive=False,
+    head=False,
+    cache=None,
+    compressed=None,
+    sidecars=None,
+    verbose=False,
+):
+    """Respond to a GET (or HEAD) request via an asyncio stream and return (status, bytes).
+
+    Bodies which have to be compressed first are compressed in a thread of the default
+    executor, so that the event loop keeps serving the other clients meanwhile.
+    """
+    try:
+        info, body, content = open_body(path, cache)
+    except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+        data = error_response(vers, 404, keep_alive, head)
+        writer.write(data)
+        return 404, len(data)
+
+    try:
+        variant = encoded_variant(path, info, body, content, headers, compressed, sidecars, cache)
+        if callable(variant):
+            variant = await asyncio.get_running_loop().run_in_executor(None, variant)
+        if variant is not None:
+            if content is not None:
+                content.close()
+            info, body, content = variant
+        status, parts = get_response(vers, info, headers, keep_alive, head)
+        for part in parts:
+            if isinstance(part, bytes):
+                writer.write(part)
+            elif body is not None:
+                offset, count = part
+                writer.write(memoryview(body)[offset : offset + count])
+            else:
+                # Hand the body to the kernel, asyncio falls back to reading it in chunks
+                # if the transport does not support sendfile() (e.g. TLS)
+                await asyncio.get_running_loop().sendfile(writer.transport, content, *part)
+        return status, parts_size(parts)
+    finally:
+        if content is not None:
+            content.close()
+
+
+async def respond_upload_async(
+    reader,
+    writer,
+    parser,
+    path,
+    vers,
+    headers,
+    keep_alive,
+    uploads,
+    timeout=5,
+    cache=None,
+    docs=None,
+):
+    """Store the body of a POST or PUT request like respond_upload(), return (status, bytes).
+
+    The file is created, written and committed in threads of the default executor, so a
+    slow disk or a large body does not hold up the other clients of the event loop.
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        decoder = body_decoder(headers, uploads.max_size)
+        target = uploads.target(path)
+        upload, tmp = await loop.run_in_executor(None, uploads.open, target)
+    except RequestError as error:
+        data = error_response(vers, error.status)
+        writer.write(data)
+        return error.status, len(data)
+
+    try:
+        if headers.get("expect", "").lower() == "100-continue":
+            writer.write(CONTINUE)
+            await writer.drain()
+        # Whatever arrived along with the request head
+        data = parser.flush()
+        while True:
+            pieces, rest = decoder.decode(data)
+            if pieces:
+                await loop.run_in_executor(None, upload.writelines, pieces)
+            if decoder.done:
+                break
+            data = await asyncio.wait_for(reader.read(ASYNC_READ_SIZE), timeout)
+            if not data:
+                uploads.abort(upload, tmp)
+                return 400, None
+        # Pipelined requests
+        parser.feed(rest)
+        created = await loop.run_in_executor(None, uploads.commit, upload, tmp, target)
+    except RequestError as error:
+        uploads.abort(upload, tmp)
+        data = error_response(vers, error.status)
+        writer.write(data)
+        return error.status, len(data)
+    except (asyncio.TimeoutError, ConnectionError):
+        uploads.abort(upload, tmp)
+        return 400, None
+    except OSError as error:
+        print("[Upload Error] %s" % (error), file=sys.stderr)
+        uploads.abort(upload, tmp)
+        data = error_response(vers, 500)
+        writer.write(data)
+        return 500, len(data)
+
+    if cache is not None:
+        cache.discard(target)
+    if docs is not None:
+        docs.add(target)
+    data = upload_response(vers, created, keep_alive)
+    writer.write(data)
+    return 201 if created else 204, len(data)
+
+
+async def serve_async(
+    reader,
+    writer,
+    docs,
+    timeout=5,
+    max_requests=100,
+    cache=None,
+    compressed=None,
+    uploads=None,
+    metrics=None,
+    access_log=None,
+    verbose=False,
+):
+    """Coroutine to serve HTTP requests. One call per client.
+
+    The connection is kept open just like with serve().
+    """
+    host, port = writer.get_extra_info("peername")[:2]
+    if verbose:
+        print("Client:     %s:%i" % (host, port), file=sys.stderr)
+
+    # asyncio only disables Nagle for sockets created with proto=IPPROTO_TCP, without it
+    # the body written after the head waits for the client's delayed ACK (~40 ms)
+    writer.get_extra_info("socket").setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    # Partial or pipelined requests are carried over from one request to the next
+    parser = RequestParser()
+
+    try:
+        for num in range(1, max_requests + 1):
+            request = await retrieve_request_async(
+                reader, writer, host, port, parser, timeout=timeout, verbose=verbose
+            )
+            if request is None:
+                break
+
+            # Split request
+            verb, path, vers, headers = request
+            keep_alive = num < max_requests and wants_keep_alive(vers, headers)
+
+            start = time.monotonic()
+            if metrics is not None:
+                metrics.begin()
+            status, sent = 500, None
+            try:
+                if verb in ["GET", "HEAD"]:
+                    head = verb == "HEAD"
+                    data = None
+                    if metrics is not None and path.split("?", 1)[0] == metrics.path:
+                        status, data = 200, metrics_response(vers, metrics, keep_alive, head)
+                    else:
+                        status, path = docs.resolve(path)
+                        if status == 200:
+                            status, sent = await respond_get_async(
+                                writer,
+                                path,
+                                vers,
+                                headers,
+                                keep_alive,
+                                head,
+                                cache,
+                                compressed,
+                                docs.sidecars.get(path),
+                                verbose=verbose,
+                            )
+                        elif status == 301:
+                            data = redirect_response(vers, path, keep_alive)
+                        else:
+                            data = error_response(vers, status, keep_alive, head)
+                    if data is not None:
+                        writer.write(data)
+                        sent = len(data)
+                elif verb in ["POST", "PUT"] and uploads is not None:
+                    status, sent = await respond_upload_async(
+                        reader,
+                        writer,
+                        parser,
+                        path,
+                        vers,
+                        headers,
+                        keep_alive,
+                        uploads,
+                        timeout,
+                        cache,
+                        docs,
+                    )
+                    # The rest of the body has not been read after errors
+                    keep_alive = keep_alive and status < 400
+                else:
+                    # Other verbs, and POST/PUT without -u, get a 501 and their body is not read
+                    keep_alive = False
+                    data = error_response(vers, 501)
+                    writer.write(data)
+                    status, sent = 501, len(data)
+                await writer.drain()
+            except ConnectionError:
+                sent = None
+                raise
+            finally:
+                duration = time.monotonic() - start
+                if metrics is not None:
+                    metrics.end(status, sent, duration)
+                if access_log is not None:
+                    access_log.log(host, request, status, sent, duration)
+
+            if sent is None or not keep_alive:
+                break
+        await writer.drain()
+    except ConnectionError as error:
+        if verbose:
+            print("[Send Error] %s" % (error), file=sys.stderr)
+    finally:
+        writer.close()
+
+
+async def accept_async(
+    s,
+    docs,
+    timeout=5,
+    max_requests=100,
+    cache=None,
+    compressed=None,
+    uploads=None,
+    metrics=None,
+    access_log=None,
+    verbose=False,
+):
+    """Serve clients from the listening socket until SIGTERM, then let in-flight ones finish."""
+    loop = asyncio.get_running_loop()
+    clients = set()
+
+    async def client_connected(reader, writer):
+        """Keep track of the serving task, so it can be waited for on shutdown."""
+        task = asyncio.current_task()
+        clients.add(task)
+        try:
+            await serve_async(
+                reader,
+                writer,
+                docs,
+                timeout,
+                max_requests,
+                cache,
+                compressed,
+                uploads,
+                metrics,
+                access_log,
+                verbose=verbose,
+            )
+        finally:
+            clients.discard(task)
+
+    server = await asyncio.start_server(client_connected, sock=s, limit=MAX_HEADER_LINE)
+
+    stop = loop.create_future()
+    loop.add_signal_handler(signal.SIGTERM, lambda: stop.done() or stop.set_result(None))
+
+    async with server:
+        await stop
+        server.close()
+        if clients:
+            await asyncio.wait(clients, timeout=SHUTDOWN_TIMEOUT)
+
+
+# -------------------------------------------------------------------------------------------------
+# THREAD POOL
+# -------------------------------------------------------------------------------------------------
+
+
+class WorkerPool:
+    """Fixed number of threads which serve clients taken from a bounded queue."""
+
+    def __init__(self, handler, threads=16, queue_size=64):
+        """Start the threads, each calling handler(c, host, port) for queued clients."""
+        self.handler = handler
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.threads = []
+        for _ in range(threads):
+            t = threading.Thread(target=self._run)
+            # if the main thread kills, this thread will be killed too.
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def submit(self, c, host, port):
+        """Queue a client to be served, returns False if the queue is full."""
+        try:
+            self.queue.put_nowait((c, host, port))
+        except queue.Full:
+            return False
+        return True
+
+    def shutdown(self, timeout=None):
+        """Let the threads finish all queued clients and wait up to timeout seconds for them."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        try:
+            for _ in self.threads:
+                self.queue.put(None, timeout=self._remaining(deadline))
+        except queue.Full:
+            return
+        for t in self.threads:
+            t.join(self._remaining(deadline))
+
+    def _run(self):
+        """Serve queued clients until told to stop."""
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            c, host, port = item
+            try:
+                self.handler(c, host, port)
+            except Exception as error:
+                print("[Serve Error] %s:%i %s" % (host, port, error), file=sys.stderr)
+                c.close()
+
+    @staticmethod
+    def _remaining(deadline):
+        """Return the seconds left until deadline (None for no deadline)."""
+        if deadline is None:
+            return None
+        return max(0, deadline - time.monotonic())
 
 
 # -------------------------------------------------------------------------------------------------
@@ -188,15 +2071,53 @@ def serve(s, host, port, docroot, index, bufsize=1024, verbose=False):
 # -------------------------------------------------------------------------------------------------
 
 
-def create_socket(verbose=False):
+def create_socket(sockopts=None, verbose=False):
     """Create TCP socket."""
     try:
         if verbose:
             print("Socket:     TCP", file=sys.stderr)
-        return socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     except socket.error as error:
         print("[Socker Error] %s", (error), file=sys.stderr)
         sys.exit(1)
+    if sockopts:
+        set_sockopts(s, sockopts, verbose=verbose)
+    return s
+
+
+def set_sockopts(s, sockopts, udp=False, verbose=False):
+    """Apply tuning options to a socket before it is bound or connected.
+
+    sockopts is a dict as returned by get_sockopts(). Options which are not set are left at
+    the system defaults. Accepted sockets inherit them from the listening socket.
+    """
+    options = []
+    if sockopts.get("reuseaddr"):
+        options.append(("SO_REUSEADDR", socket.SOL_SOCKET, socket.SO_REUSEADDR, 1))
+    if sockopts.get("reuseport"):
+        if not hasattr(socket, "SO_REUSEPORT"):
+            print("[Socket Error] SO_REUSEPORT is not supported", file=sys.stderr)
+            s.close()
+            sys.exit(1)
+        options.append(("SO_REUSEPORT", socket.SOL_SOCKET, socket.SO_REUSEPORT, 1))
+    if sockopts.get("rcvbuf"):
+        options.append(("SO_RCVBUF", socket.SOL_SOCKET, socket.SO_RCVBUF, sockopts["rcvbuf"]))
+    if sockopts.get("sndbuf"):
+        options.append(("SO_SNDBUF", socket.SOL_SOCKET, socket.SO_SNDBUF, sockopts["sndbuf"]))
+    if sockopts.get("keepalive") and not udp:
+        options.append(("SO_KEEPALIVE", socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1))
+    if sockopts.get("nodelay") and not udp:
+        options.append(("TCP_NODELAY", socket.IPPROTO_TCP, socket.TCP_NODELAY, 1))
+
+    for name, level, option, value in options:
+        if verbose:
+            print("Sockopt:    %s=%i" % (name, value), file=sys.stderr)
+        try:
+            s.setsockopt(level, option, value)
+        except (OSError, socket.error) as error:
+            print("[Socket Error] %s: %s" % (name, error), file=sys.stderr)
+            s.close()
+            sys.exit(1)
 
 
 def bind(s, host, port, verbose=False):
@@ -242,42 +2163,339 @@ def accept(s, verbose=False):
     return c, host, port
 
 
+# -------------------------------------------------------------------------------------------------
+# SERVING ENGINES
+# -------------------------------------------------------------------------------------------------
+
+# Seconds a stopping server waits for its clients to be served
+SHUTDOWN_TIMEOUT = 10
+
+
+class Shutdown(Exception):
+    """Raised inside a worker process when it has been asked to stop."""
+
+
+def accept_loop(s, pool, verbose=False):
+    """Accept clients endlessly and hand them to the worker pool.
+
+    Clients which arrive while all threads are busy and the queue is full are
+    turned away with a 503 right away instead of piling up.
+    """
+    while True:
+        # Blocking call until a new client connects
+        c, h, p = accept(s, verbose=verbose)
+        if not pool.submit(c, h, p):
+            if verbose:
+                print("%s:%i > 503 Service Unavailable" % (h, p), file=sys.stderr)
+            respond_unavailable(c, verbose=verbose)
+
+
+def run_threads(
+    s,
+    docs,
+    bufsize=1024,
+    threads=16,
+    queue_size=64,
+    timeout=5,
+    max_requests=100,
+    cache=None,
+    compressed=None,
+    uploads=None,
+    metrics=None,
+    access_log=None,
+    verbose=False,
+):
+    """Serve clients from the listening socket with a pool of threads until Shutdown.
+
+    A kept-alive connection occupies its thread until it is closed or has timed out.
+    """
+    docs.start()
+    if access_log is not None:
+        access_log.start()
+
+    # Called by the pool threads for every client
+    handler = functools.partial(
+        serve,
+        docs=docs,
+        bufsize=bufsize,
+        timeout=timeout,
+        max_requests=max_requests,
+        cache=cache,
+        compressed=compressed,
+        uploads=uploads,
+        metrics=metrics,
+        access_log=access_log,
+        verbose=verbose,
+    )
+    pool = WorkerPool(handler, threads=threads, queue_size=queue_size)
+    try:
+        accept_loop(s, pool, verbose=verbose)
+    except Shutdown:
+        pass
+
+    # Stop accepting and give queued and in-flight requests a chance to finish
+    s.close()
+    pool.shutdown(SHUTDOWN_TIMEOUT)
+    if access_log is not None:
+        access_log.close()
+    if verbose:
+        print_cache_stats(cache, compressed)
+
+
+def run_asyncio(
+    s,
+    docs,
+    timeout=5,
+    max_requests=100,
+    cache=None,
+    compressed=None,
+    uploads=None,
+    metrics=None,
+    access_log=None,
+    verbose=False,
+):
+    """Serve clients from the listening socket with an asyncio event loop until SIGTERM."""
+    docs.start()
+    if access_log is not None:
+        access_log.start()
+    asyncio.run(
+        accept_async(
+            s,
+            docs,
+            timeout,
+            max_requests,
+            cache,
+            compressed,
+            uploads,
+            metrics,
+            access_log,
+            verbose=verbose,
+        )
+    )
+    s.close()
+    if access_log is not None:
+        access_log.close()
+    if verbose:
+        print_cache_stats(cache, compressed)
+
+
 # -------------------------------------------------------------------------------------------------
 # SERVER
 # -------------------------------------------------------------------------------------------------
 
 
-def run_server(host, port, docroot, index, backlog=1, bufsize=1024, verbose=False):
-    """Start TCP/UDP server on host/port and wait endlessly to sent/receive data."""
-    s = create_socket(verbose=verbose)
+def open_listener(host, port, backlog=1, sockopts=None, verbose=False):
+    """Create a TCP socket listening on host/port."""
+    s = create_socket(sockopts=sockopts, verbose=verbose)
 
     bind(s, host, port, verbose=verbose)
     listen(s, backlog=backlog, verbose=verbose)
 
+    return s
+
+
+def run_server(
+    host,
+    port,
+    docroot,
+    index,
+    backlog=1,
+    bufsize=1024,
+    sockopts=None,
+    workers=0,
+    engine="threads",
+    threads=16,
+    queue_size=64,
+    timeout=5,
+    max_requests=100,
+    cache_size=0,
+    compress_size=0,
+    uploads=None,
+    rescan=0,
+    access_log=None,
+    metrics_path=None,
+    verbose=False,
+):
+    """Start TCP/UDP server on host/port and wait endlessly to sent/receive data."""
+    sockopts = sockopts or {}
+
+    # Resolves request paths, every worker process rescans it on its own
+    docs = DocrootIndex(docroot, index, rescan)
+
+    # Every worker process ends up with a cache of its own
+    cache = FileCache(cache_size) if cache_size else None
+    compressed = CompressedCache(compress_size) if compress_size else None
+
+    # Shared by all worker processes, whereas each of them writes the access log on its own
+    metrics = Metrics(metrics_path) if metrics_path else None
+    if metrics is not None and docs.resolve(metrics_path)[0] == 200:
+        print(
+            "[Metrics Error] %s hides the docroot file of the same path" % (metrics_path),
+            file=sys.stderr,
+        )
+
+    # Serves all clients of a listening socket
+    if engine == "asyncio":
+        run = functools.partial(
+            run_asyncio,
+            docs=docs,
+            timeout=timeout,
+            max_requests=max_requests,
+            cache=cache,
+            compressed=compressed,
+            uploads=uploads,
+            metrics=metrics,
+            access_log=access_log,
+            verbose=verbose,
+        )
+    else:
+        run = functools.partial(
+            run_threads,
+            docs=docs,
+            bufsize=bufsize,
+            threads=threads,
+            queue_size=queue_size,
+            timeout=timeout,
+            max_requests=max_requests,
+            cache=cache,
+            compressed=compressed,
+            uploads=uploads,
+            metrics=metrics,
+            access_log=access_log,
+            verbose=verbose,
+        )
+
+    # With SO_REUSEPORT every worker binds a socket of its own and the kernel
+    # balances new connections between them, otherwise they share this one.
+    s = None
+    if not workers or not sockopts.get("reuseport"):
+        s = open_listener(host, port, backlog=backlog, sockopts=sockopts, verbose=verbose)
+
     if verbose:
         print("Receiving:  bufsize=%i" % (bufsize), file=sys.stderr)
-        print("Docroot:    %s" % docroot, file=sys.stderr)
+        print("Docroot:    %s (%i files)" % (docroot, len(docs.files)), file=sys.stderr)
         print("Index:      %s" % index, file=sys.stderr)
+        print("Rescan:     %s" % ("every %is" % rescan if rescan else "off"), file=sys.stderr)
+        print("Keep-Alive: timeout=%i, max=%i" % (timeout, max_requests), file=sys.stderr)
+        print("Cache:      %i bytes" % (cache_size), file=sys.stderr)
+        print(
+            "Compressed: %i bytes (%s)"
+            % (compress_size, ", ".join(enc for enc, _, compress in ENCODINGS if compress)),
+            file=sys.stderr,
+        )
+        if uploads is not None:
+            print(
+                "Uploads:    %s (max=%i, fsync=%s)"
+                % (uploads.directory, uploads.max_size, uploads.fsync),
+                file=sys.stderr,
+            )
+        if access_log is not None:
+            print("Access log: %s (%s)" % (access_log.path, access_log.fmt), file=sys.stderr)
+        print("Metrics:    %s" % (metrics_path or "off"), file=sys.stderr)
+        if engine == "asyncio":
+            print("Engine:     asyncio", file=sys.stderr)
+        else:
+            print("Threads:    %i (queue=%i)" % (threads, queue_size), file=sys.stderr)
+
+    if workers:
+        run_workers(
+            s, host, port, run, workers, backlog=backlog, sockopts=sockopts, verbose=verbose
+        )
+    else:
+        run(s)
 
-    # Accept clients
-    while True:
-        # Blocking call until a new client connects
-        c, h, p = accept(s, verbose=verbose)
-        t = threading.Thread(
-            target=serve,
-            args=(c,),
-            kwargs={
-                "host": h,
-                "port": p,
-                "docroot": docroot,
-                "index": index,
-                "bufsize": bufsize,
-                "verbose": verbose,
-            },
+
+# -------------------------------------------------------------------------------------------------
+# PRE-FORKED WORKERS
+# -------------------------------------------------------------------------------------------------
+
+# Minimum seconds between two restarts of crashed workers
+RESPAWN_DELAY = 1
+
+
+def _raise_shutdown(signum, frame):
+    """Signal handler which interrupts the accept loop of a worker."""
+    raise Shutdown()
+
+
+def run_worker(s, host, port, run, backlog=1, sockopts=None, verbose=False):
+    """Serve clients via run(s) in a forked worker process until SIGTERM and then exit it.
+
+    If s is None the worker creates its own listening socket (SO_REUSEPORT).
+    """
+    signal.signal(signal.SIGTERM, _raise_shutdown)
+    # Ctrl+c reaches the whole process group, the master takes care of it
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    try:
+        if s is None:
+            s = open_listener(host, port, backlog=backlog, sockopts=sockopts, verbose=verbose)
+        run(s)
+    except Shutdown:
+        pass
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os._exit(0)
+
+
+def run_workers(s, host, port, run, workers, backlog=1, sockopts=None, verbose=False):
+    """Fork worker processes which accept and serve clients and supervise them.
+
+    Workers which die are restarted. On SIGTERM or SIGINT all workers are asked to stop
+    gracefully and the master returns once all of them have exited.
+    """
+    children = {}
+    stopping = []
+
+    def spawn(num):
+        """Fork worker number num."""
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            run_worker(s, host, port, run, backlog=backlog, sockopts=sockopts, verbose=verbose)
+        children[pid] = num
+        if verbose:
+            print("Worker:     #%i pid=%i" % (num, pid), file=sys.stderr)
+
+    def stop(signum, frame):
+        """Ask all workers to stop."""
+        stopping.append(signum)
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for num in range(workers):
+        spawn(num)
+
+    last_respawn = 0
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        num = children.pop(pid, None)
+        if num is None or stopping:
+            continue
+
+        print(
+            "[Worker Error] #%i pid=%i exited with status %i" % (num, pid, status), file=sys.stderr
         )
-        # if the main thread kills, this thread will be killed too.
-        t.daemon = True
-        t.start()
+        # Don't turn a worker crashing on startup into a fork loop
+        delay = last_respawn + RESPAWN_DELAY - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        last_respawn = time.monotonic()
+        spawn(num)
+
+    if s is not None:
+        s.close()
 
 
 # -------------------------------------------------------------------------------------------------
@@ -308,6 +2526,95 @@ def _args_check_docroot(value):
     return strvalue
 
 
+def _args_check_count(value):
+    """Check arguments for invalid (negative) counts."""
+    intvalue = int(value)
+
+    if intvalue < 0:
+        raise argparse.ArgumentTypeError("%s is an invalid count." % value)
+    return intvalue
+
+
+def _args_check_size(value):
+    """Check arguments for invalid (non-positive) sizes."""
+    intvalue = int(value)
+
+    if intvalue < 1:
+        raise argparse.ArgumentTypeError("%s is an invalid size." % value)
+    return intvalue
+
+
+def add_sockopt_args(parser, backlog, bufsize):
+    """Add socket tuning arguments to the parser, using the given defaults."""
+    group = parser.add_argument_group("socket tuning")
+    group.add_argument(
+        "--backlog",
+        metavar="NUM",
+        type=_args_check_size,
+        default=backlog,
+        required=False,
+        help="length of the listen queue (default: %i)" % (backlog),
+    )
+    group.add_argument(
+        "--bufsize",
+        metavar="BYTES",
+        type=_args_check_size,
+        default=bufsize,
+        required=False,
+        help="number of bytes to read per recv() call (default: %i)" % (bufsize),
+    )
+    group.add_argument(
+        "--rcvbuf",
+        metavar="BYTES",
+        type=_args_check_size,
+        required=False,
+        help="kernel receive buffer size SO_RCVBUF (default: system)",
+    )
+    group.add_argument(
+        "--sndbuf",
+        metavar="BYTES",
+        type=_args_check_size,
+        required=False,
+        help="kernel send buffer size SO_SNDBUF (default: system)",
+    )
+    group.add_argument(
+        "--nodelay",
+        action="store_true",
+        required=False,
+        help="disable Nagle's algorithm (TCP_NODELAY)",
+    )
+    group.add_argument(
+        "--reuseaddr",
+        action="store_true",
+        required=False,
+        help="allow binding to an address in TIME_WAIT (SO_REUSEADDR)",
+    )
+    group.add_argument(
+        "--reuseport",
+        action="store_true",
+        required=False,
+        help="allow several sockets to bind the same port (SO_REUSEPORT)",
+    )
+    group.add_argument(
+        "--keepalive",
+        action="store_true",
+        required=False,
+        help="enable TCP keepalive probes (SO_KEEPALIVE)",
+    )
+
+
+def get_sockopts(args):
+    """Return the socket tuning options from the parsed arguments as dict."""
+    return {
+        "rcvbuf": args.rcvbuf,
+        "sndbuf": args.sndbuf,
+        "nodelay": args.nodelay,
+        "reuseaddr": args.reuseaddr,
+        "reuseport": args.reuseport,
+        "keepalive": args.keepalive,
+    }
+
+
 def get_args():
     """Retrieve command line arguments."""
     parser = argparse.ArgumentParser(description="Python httpd server.")
@@ -334,6 +2641,138 @@ def get_args():
         required=False,
         help="defines the file that will be served as index (default: index.html)",
     )
+    parser.add_argument(
+        "--rescan",
+        metavar="SECONDS",
+        type=_args_check_count,
+        default=5,
+        required=False,
+        help="rescan the docroot for added, changed or removed files every this many seconds, "
+        "0 only scans it on startup (default: 5)",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        metavar="NUM",
+        type=_args_check_count,
+        default=0,
+        required=False,
+        help="number of pre-forked worker processes, each with its own accept loop. "
+        "Combine with --reuseport to give each worker its own listening socket "
+        "(default: 0, serve from the main process)",
+    )
+    parser.add_argument(
+        "-e",
+        "--engine",
+        choices=["asyncio", "threads"],
+        default="threads",
+        required=False,
+        help="threads: thread pool with blocking sockets, asyncio: single-threaded event loop "
+        "(default: threads)",
+    )
+    parser.add_argument(
+        "-t",
+        "--threads",
+        metavar="NUM",
+        type=_args_check_size,
+        default=16,
+        required=False,
+        help="number of threads serving clients per process (default: 16)",
+    )
+    parser.add_argument(
+        "-q",
+        "--queue",
+        metavar="NUM",
+        type=_args_check_size,
+        default=64,
+        required=False,
+        help="number of accepted clients waiting for a thread, further clients "
+        "get a 503 response (default: 64)",
+    )
+    parser.add_argument(
+        "--idle-timeout",
+        metavar="SECONDS",
+        type=_args_check_size,
+        default=5,
+        required=False,
+        help="close kept-alive connections after this many idle seconds (default: 5)",
+    )
+    parser.add_argument(
+        "--max-requests",
+        metavar="NUM",
+        type=_args_check_size,
+        default=100,
+        required=False,
+        help="close connections after serving this many requests, 1 disables keep-alive "
+        "(default: 100)",
+    )
+    parser.add_argument(
+        "--cache-size",
+        metavar="BYTES",
+        type=_args_check_count,
+        default=16777216,
+        required=False,
+        help="memory for caching files of up to a quarter of this size, 0 disables the "
+        "cache (default: 16777216)",
+    )
+    parser.add_argument(
+        "--compress-size",
+        metavar="BYTES",
+        type=_args_check_count,
+        default=8388608,
+        required=False,
+        help="memory for caching bodies compressed on the fly for clients sending "
+        "Accept-Encoding, files of up to a quarter of this size are compressed, 0 only "
+        "serves precompressed .br/.zst/.gz files (default: 8388608)",
+    )
+    parser.add_argument(
+        "-u",
+        "--upload",
+        metavar="DIR",
+        type=_args_check_docroot,
+        required=False,
+        help="store the bodies of POST and PUT requests as files below this directory, "
+        "which may be the docroot (default: uploads are disabled)",
+    )
+    parser.add_argument(
+        "--max-upload",
+        metavar="BYTES",
+        type=_args_check_size,
+        default=104857600,
+        required=False,
+        help="largest accepted upload (default: 104857600)",
+    )
+    parser.add_argument(
+        "--fsync",
+        choices=Uploads.FSYNC,
+        default="file",
+        required=False,
+        help="none: leave flushing uploads to the kernel, file: fsync uploaded files, "
+        "dir: also fsync their directory (default: file)",
+    )
+    parser.add_argument(
+        "--access-log",
+        metavar="FILE",
+        required=False,
+        help="append an entry for every request to this file, - for stdout "
+        "(default: no access log)",
+    )
+    parser.add_argument(
+        "--log-format",
+        choices=AccessLog.FORMATS,
+        default="common",
+        required=False,
+        help="common: Common Log Format, json: one JSON object per line (default: common)",
+    )
+    parser.add_argument(
+        "--metrics",
+        metavar="PATH",
+        default=None,
+        required=False,
+        help="serve request metrics in the Prometheus text format on this path instead of "
+        "a file, e.g. /metrics (default: no metrics)",
+    )
+    add_sockopt_args(parser, backlog=128, bufsize=65536)
     parser.add_argument("hostname", type=str, help="address to listen on")
     parser.add_argument("port", type=_args_check_port, help="port to listen on")
     return parser.parse_args()
@@ -348,16 +2787,26 @@ def main():
     """Start the program."""
     args = get_args()
 
-    listen_backlog = 1
-    receive_buffer = 1024
-
     run_server(
         args.hostname,
         args.port,
         args.root,
         args.index,
-        backlog=listen_backlog,
-        bufsize=receive_buffer,
+        backlog=args.backlog,
+        bufsize=args.bufsize,
+        sockopts=get_sockopts(args),
+        workers=args.workers,
+        engine=args.engine,
+        threads=args.threads,
+        queue_size=args.queue,
+        timeout=args.idle_timeout,
+        max_requests=args.max_requests,
+        cache_size=args.cache_size,
+        compress_size=args.compress_size,
+        rescan=args.rescan,
+        uploads=None if args.upload is None else Uploads(args.upload, args.max_upload, args.fsync),
+        access_log=None if args.access_log is None else AccessLog(args.access_log, args.log_format),
+        metrics_path=args.metrics,
         verbose=args.verbose,
     )
 
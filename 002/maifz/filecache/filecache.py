@@ -0,0 +1,104 @@
+"""Filecache classes."""
+import datetime
+import email.utils
+import os
+import stat
+import time
+
+
+class CacheEntry:
+    """Body of a file along with its pre-encoded response headers."""
+
+    def __init__(self, body, st, content_type):
+        """Encode the headers of a file with the given stat() result.
+
+        The body is None for files which are too large to be cached.
+        """
+        self.body = body
+        self.size = st.st_size if body is None else len(body)
+        self.identity = (st.st_ino, st.st_size, st.st_mtime_ns)
+        self.etag = '"%x-%x"' % (st.st_mtime_ns, st.st_size)
+        self.mtime = int(st.st_mtime)
+        validators = "ETag: %s\r\nLast-Modified: %s\r\n" % (
+            self.etag,
+            email.utils.formatdate(self.mtime, usegmt=True),
+        )
+        self.head = (
+            "Content-Type: %s\r\nContent-Length: %i\r\n%s\r\n"
+            % (content_type, self.size, validators)
+        ).encode("latin-1")
+        self.validators = (validators + "\r\n").encode("latin-1")
+
+
+class FileCache:
+    """In-memory copy of a single file, which is served without any file I/O.
+
+    The file is only stat()ed again once REVALIDATE seconds have passed since the
+    last check and re-read if its inode, size or mtime has changed. Of files larger
+    than MAX_SIZE only the headers are cached, their body has to be streamed.
+    """
+
+    # Seconds a cached file is served without checking whether it has changed on disk
+    REVALIDATE = 1.0
+
+    # Largest file kept in memory
+    MAX_SIZE = 1048576
+
+    def __init__(self, file_path, content_type):
+        """Cache nothing yet, the file is read on first use."""
+        self.file_path = file_path
+        self.content_type = content_type
+        self.entry = None
+        self.checked = None
+
+    def getEntry(self):
+        """Return the CacheEntry of the file.
+
+        - @throws FileNotFoundError
+        """
+        entry, checked = self.entry, self.checked
+        now = time.monotonic()
+        if checked is None or now - checked >= self.REVALIDATE:
+            entry = self.revalidate(entry)
+            self.entry, self.checked = entry, now
+        if entry is None:
+            raise FileNotFoundError
+        return entry
+
+    def revalidate(self, entry):
+        """Return entry if the file is unchanged, a new entry or None if it is gone."""
+        try:
+            st = os.stat(self.file_path)
+        except OSError:
+            return None
+        if not stat.S_ISREG(st.st_mode):
+            return None
+        if entry is not None and entry.identity == (st.st_ino, st.st_size, st.st_mtime_ns):
+            return entry
+        if st.st_size > self.MAX_SIZE:
+            return CacheEntry(None, st, self.content_type)
+        try:
+            with open(self.file_path, "rb") as file:
+                st = os.fstat(file.fileno())
+                body = file.read()
+        except OSError:
+            return None
+        return CacheEntry(body, st, self.content_type)
+
+    @staticmethod
+    def isNotModified(entry, headers):
+        """Return True if the conditional request headers match the cached file."""
+        if_none_match = headers.get("If-None-Match")
+        if if_none_match is not None:
+            tags = [tag.strip() for tag in if_none_match.split(",")]
+            return "*" in tags or entry.etag in tags or "W/" + entry.etag in tags
+        if_modified_since = headers.get("If-Modified-Since")
+        if if_modified_since is not None:
+            try:
+                since = email.utils.parsedate_to_datetime(if_modified_since)
+            except (TypeError, ValueError, IndexError):
+                return False
+            if since.tzinfo is None:
+                since = since.replace(tzinfo=datetime.timezone.utc)
+            return since.timestamp() >= entry.mtime
+        return False
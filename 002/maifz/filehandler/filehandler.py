@@ -1,16 +1,183 @@
-"""Filehandler class."""
+"""Filehandler classes."""
+import contextlib
+import mmap
 import os
+import queue
+import socket
+import sys
+import threading
+
+
+class PendingRecord:
+    """Record waiting to be appended, its writer is woken up once it is done."""
+
+    def __init__(self, data):
+        """Queue data."""
+        self.data = data
+        self.done = threading.Event()
+        self.error = None
+
+
+class AppendWriter:
+    """Appends records to a file which is kept open, with one of these fsync policies.
+
+    - none: records are written right away, flushing is left to the kernel
+    - interval: records are written right away and a thread syncs the file at most every
+      interval seconds, so at most that much is lost on a crash
+    - batch: group commit, writers queue their records and wait. A thread takes whatever
+      has been queued meanwhile, writes it with as few writev() calls as possible and
+      syncs the file once for the whole batch before waking up its writers.
+
+    The file is opened with O_APPEND, so every record is written by a single call and
+    records of concurrent writers (threads or processes) never interleave.
+    """
+
+    FSYNC = ["none", "interval", "batch"]
+
+    # Separates the records in the file
+    SEPARATOR = b"\n\r"
+
+    # Most records written (and synced) at once
+    MAX_BATCH = 1024
+
+    # Most buffers passed to a single writev() call
+    IOV_MAX = os.sysconf("SC_IOV_MAX") if hasattr(os, "sysconf") else 1024
+
+    def __init__(self, file_path, fsync="batch", interval=1.0):
+        """Open an existing file for appending.
+
+        - @throws FileNotFoundError
+        """
+        self.fd = os.open(file_path, os.O_WRONLY | os.O_APPEND)
+        self.fsync = fsync
+        self.interval = interval
+        self.dirty = False
+        self.queue = queue.Queue()
+        self.thread = None
+        if fsync != "none":
+            self.thread = threading.Thread(
+                target=self.runBatches if fsync == "batch" else self.runInterval
+            )
+            self.thread.daemon = True
+            self.thread.start()
+
+    def append(self, data):
+        """Append a record and return once it has been written according to the fsync policy.
+
+        - @throws OSError
+        """
+        if self.fsync != "batch":
+            self.writeAll(self.fd, [data, self.SEPARATOR])
+            self.dirty = True
+            return
+        record = PendingRecord(data)
+        self.queue.put(record)
+        record.done.wait()
+        if record.error is not None:
+            raise record.error
+
+    def close(self):
+        """Write all queued records, sync them and close the file."""
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+        os.close(self.fd)
+
+    def runBatches(self):
+        """Write and sync batches of queued records until told to stop."""
+        while True:
+            batch = [self.queue.get()]
+            while batch[-1] is not None and len(batch) < self.MAX_BATCH:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            records = [record for record in batch if record is not None]
+
+            error = None
+            if records:
+                buffers = []
+                for record in records:
+                    buffers.append(record.data)
+                    buffers.append(self.SEPARATOR)
+                try:
+                    self.writeAll(self.fd, buffers)
+                    self.sync(self.fd)
+                except OSError as err:
+                    error = err
+
+            for record in records:
+                record.error = error
+                record.done.set()
+            if batch[-1] is None:
+                return
+
+    def runInterval(self):
+        """Sync the file every interval seconds if it has been written to, until told to stop."""
+        stopping = False
+        while not stopping:
+            try:
+                stopping = self.queue.get(timeout=self.interval) is None
+            except queue.Empty:
+                pass
+            if self.dirty:
+                self.dirty = False
+                try:
+                    self.sync(self.fd)
+                except OSError as error:
+                    print("[Sync Error] %s" % (error), file=sys.stderr)
+
+    @staticmethod
+    def writeAll(fd, buffers):
+        """Write all buffers to fd, with a single writev() call unless it is cut short."""
+        first = 0
+        while first < len(buffers):
+            written = os.writev(fd, buffers[first : first + AppendWriter.IOV_MAX])
+            # Skip what has been written, a partial write leaves the rest of a buffer
+            while written:
+                size = len(buffers[first])
+                if written < size:
+                    buffers[first] = memoryview(buffers[first])[written:]
+                    break
+                written -= size
+                first += 1
+
+    # Appending changes the file size, which fdatasync() takes care of as well
+    sync = staticmethod(getattr(os, "fdatasync", os.fsync))
 
 
 class FileHandler:
     """Filehandler helper for read and write."""
 
+    def __init__(self, fsync="batch", interval=1.0):
+        """Append to files with the given fsync policy (see AppendWriter)."""
+        self.fsync = fsync
+        self.interval = interval
+        self.writers = {}
+        self.lock = threading.Lock()
+
     def appendToFile(self, file_path, data):
-        """Write data into file of given path."""
-        if not os.path.isfile(file_path):
-            return False
-        with open(file_path, "a") as file:
-            file.write(data.decode("utf-8") + "\n\r")
+        """Write data into file of given path.
+
+        Returns False if the file does not exist and True once data has been written.
+        - @throws OSError
+        """
+        with self.lock:
+            writer = self.writers.get(file_path)
+            if writer is None:
+                if not os.path.isfile(file_path):
+                    return False
+                writer = AppendWriter(file_path, self.fsync, self.interval)
+                self.writers[file_path] = writer
+        writer.append(data)
+        return True
+
+    def close(self):
+        """Write everything which is queued and close all files."""
+        with self.lock:
+            for writer in self.writers.values():
+                writer.close()
+            self.writers = {}
 
     def readFile(self, file_path):
         """Read file of given file path.
@@ -21,3 +188,56 @@ class FileHandler:
             raise FileNotFoundError
         with open(file_path, "rb") as file:
             return file.read()
+
+    # Bytes read at once by readChunks()
+    CHUNK_SIZE = 65536
+
+    def readChunks(self, file_path, chunk_size=CHUNK_SIZE):
+        """Yield the content of file of given file path in chunks, in constant memory.
+
+        - @throws FileNotFoundError
+        """
+        with open(file_path, "rb") as file:
+            while True:
+                chunk = file.read(chunk_size)
+                if not chunk:
+                    return
+                yield chunk
+
+    @contextlib.contextmanager
+    def mapFile(self, file_path):
+        """Provide a read-only memoryview of file of given file path, backed by the page cache.
+
+        - @throws FileNotFoundError
+        - @throws ValueError for empty files, which cannot be mapped
+        """
+        with open(file_path, "rb") as file:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                with memoryview(mapped) as view:
+                    yield view
+
+    def sendFile(self, file_path, target, count):
+        """Send count bytes of file of given file path to target and return how many were sent.
+
+        Sockets get the file via sendfile() without copying it through userspace, other
+        writable targets get slices of a mapping of it or chunks if it cannot be mapped.
+        - @throws OSError
+        """
+        if isinstance(target, socket.socket):
+            with open(file_path, "rb") as file:
+                return target.sendfile(file, 0, count)
+        sent = 0
+        try:
+            with self.mapFile(file_path) as view:
+                while sent < min(count, len(view)):
+                    sent += target.write(view[sent : min(count, sent + self.CHUNK_SIZE)])
+            return sent
+        except ValueError:
+            pass
+        for chunk in self.readChunks(file_path):
+            chunk = chunk[: count - sent]
+            target.write(chunk)
+            sent += len(chunk)
+            if sent == count:
+                break
+        return sent
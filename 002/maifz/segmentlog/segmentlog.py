@@ -0,0 +1,417 @@
+"""Segmentlog classes."""
+import bisect
+import collections
+import functools
+import os
+import queue
+import struct
+import sys
+import threading
+import time
+import zlib
+from filehandler.filehandler import AppendWriter
+from filehandler.filehandler import PendingRecord
+
+
+# Header of every record in a segment: sequence number, time, length and CRC-32 of the data
+RECORD = struct.Struct("<QdII")
+
+# Entry of the sparse index of a segment: sequence number and time of a record and its offset
+INDEX_ENTRY = struct.Struct("<QdQ")
+
+LogRecord = collections.namedtuple("LogRecord", ["seq", "time", "data"])
+
+
+class IndexColumn:
+    """One field of all entries of an encoded sparse index, as a sequence to bisect."""
+
+    def __init__(self, index, field):
+        """Wrap the encoded index."""
+        self.index = index
+        self.field = field
+
+    def __len__(self):
+        """Return the number of index entries."""
+        return len(self.index) // INDEX_ENTRY.size
+
+    def __getitem__(self, num):
+        """Return the field of entry number num, negative numbers count from the end."""
+        if num < 0:
+            num += len(self)
+        return INDEX_ENTRY.unpack_from(self.index, num * INDEX_ENTRY.size)[self.field]
+
+
+@functools.lru_cache(maxsize=16)
+def readIndex(index_path):
+    """Return the encoded sparse index of a segment which is no longer written to."""
+    with open(index_path, "rb") as file:
+        return file.read()
+
+
+def readRecords(file, end=None):
+    """Yield (offset, LogRecord) for the records of a segment file from its current position.
+
+    Stops at the end of the file, at a torn or corrupt record or at seq end.
+    """
+    offset = file.tell()
+    while True:
+        header = file.read(RECORD.size)
+        if len(header) < RECORD.size:
+            return
+        seq, when, length, crc = RECORD.unpack(header)
+        if end is not None and seq >= end:
+            return
+        data = file.read(length)
+        if len(data) < length or zlib.crc32(data) != crc:
+            return
+        yield offset, LogRecord(seq, when, data)
+        offset += RECORD.size + length
+
+
+class SegmentLog:
+    """Append-only log of records, split into segment files with a sparse index each.
+
+    Every record gets a sequence number and a time. A new segment is started once the
+    active one has reached segment_size bytes or is older than segment_age seconds.
+    The segment files are named by the sequence number of their first record and every
+    INDEX_INTERVAL bytes an entry is added to the index file next to it, so records are
+    found by sequence number or time with two binary searches and a short scan.
+
+    Records are appended by a single thread in batches, which are synced according to
+    the fsync policy (see AppendWriter). The index is not synced along with every batch,
+    as it is rebuilt from the last segment when the log is opened. A batch which fails to be
+    written or synced is cut off again and its sequence numbers are skipped. Only one process
+    may append to a log at a time.
+    """
+
+    # Bytes of records between two entries of the sparse index
+    INDEX_INTERVAL = 4096
+
+    def __init__(
+        self, directory, segment_size=67108864, segment_age=3600, fsync="batch", interval=1.0
+    ):
+        """Open the log in directory (created if needed) and recover its last segment."""
+        self.directory = directory
+        self.segment_size = segment_size
+        self.segment_age = segment_age
+        self.fsync = fsync
+        self.interval = interval
+        # First sequence number and time of every segment
+        self.segments = []
+        self.segment_times = []
+        # Active segment
+        self.fd = None
+        self.index_fd = None
+        self.index = bytearray()
+        self.size = 0
+        self.indexed = 0
+        # Records below this sequence number are complete and can be read
+        self.next_seq = 1
+        self.last_time = 0.0
+        # Error after which no records are accepted any more
+        self.error = None
+        self.lock = threading.Lock()
+
+        os.makedirs(directory, exist_ok=True)
+        self.recover()
+
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    # ---------------------------------------------------------------------------------------------
+    # Writing
+    # ---------------------------------------------------------------------------------------------
+
+    def append(self, data):
+        """Append a record and return its sequence number once written as per the fsync policy.
+
+        - @throws OSError
+        """
+        record = PendingRecord(data)
+        self.queue.put(record)
+        record.done.wait()
+        if record.error is not None:
+            raise record.error
+        return record.seq
+
+    def close(self):
+        """Write all queued records, sync them and close the active segment."""
+        self.queue.put(None)
+        self.thread.join()
+        self.closeSegment()
+
+    def run(self):
+        """Write batches of queued records until told to stop."""
+        last_sync = time.monotonic()
+        dirty = False
+        stopping = False
+        while not stopping:
+            timeout = None
+            if dirty:
+                timeout = max(0, last_sync + self.interval - time.monotonic())
+            try:
+                batch = [self.queue.get(timeout=timeout)]
+            except queue.Empty:
+                batch = []
+            while batch and batch[-1] is not None and len(batch) < AppendWriter.MAX_BATCH:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stopping = bool(batch) and batch[-1] is None
+            records = [record for record in batch if record is not None]
+
+            error = self.error
+            if error is None:
+                mark = (
+                    len(self.segments),
+                    self.size if self.fd is not None else None,
+                    len(self.index),
+                )
+                try:
+                    if records:
+                        self.writeBatch(records)
+                        dirty = self.fsync != "none"
+                    now = time.monotonic()
+                    due = self.fsync == "batch" or stopping or now - last_sync >= self.interval
+                    if dirty and due:
+                        AppendWriter.sync(self.fd)
+                        last_sync = now
+                        dirty = False
+                except OSError as err:
+                    error = err
+                    print("[Log Error] %s" % (error), file=sys.stderr)
+                    self.rollback(mark)
+                    dirty = False
+
+            if records and self.error is None:
+                with self.lock:
+                    # The numbers of failed records are skipped rather than reused
+                    self.next_seq += len(records)
+            for record in records:
+                record.error = error
+                record.done.set()
+
+    def writeBatch(self, records):
+        """Assign sequence numbers to records, then encode and write them, rotating segments."""
+        now = max(time.time(), self.last_time)
+        seq = self.next_seq
+        buffers = []
+        entries = []
+        size = self.size
+        for record in records:
+            if (
+                self.fd is None
+                or size >= self.segment_size
+                or now - self.segment_times[-1] >= self.segment_age
+            ):
+                self.writeSegment(buffers, entries, size)
+                buffers, entries = [], []
+                self.startSegment(seq, now)
+                size = 0
+            if size == 0 or size - self.indexed >= self.INDEX_INTERVAL:
+                entries.append(INDEX_ENTRY.pack(seq, now, size))
+                self.indexed = size
+            record.seq = seq
+            header = RECORD.pack(seq, now, len(record.data), zlib.crc32(record.data))
+            buffers += [header, record.data]
+            size += len(header) + len(record.data)
+            seq += 1
+        self.writeSegment(buffers, entries, size)
+        self.last_time = now
+
+    def writeSegment(self, buffers, entries, size):
+        """Write encoded records and index entries to the active segment."""
+        if buffers:
+            AppendWriter.writeAll(self.fd, buffers)
+            self.size = size
+        if entries:
+            data = b"".join(entries)
+            AppendWriter.writeAll(self.index_fd, [data])
+            with self.lock:
+                self.index += data
+
+    def startSegment(self, seq, now):
+        """Close the active segment and start a new one with record seq."""
+        self.closeSegment()
+        path = self.segmentPath(seq)
+        self.fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self.index_fd = os.open(path[:-4] + ".idx", os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        if self.fsync != "none":
+            # The new files have to survive a crash along with the records in them
+            dirfd = os.open(self.directory, os.O_RDONLY)
+            try:
+                os.fsync(dirfd)
+            finally:
+                os.close(dirfd)
+        self.size = 0
+        self.indexed = 0
+        with self.lock:
+            self.index = bytearray()
+            self.segments.append(seq)
+            self.segment_times.append(now)
+
+    def rollback(self, mark):
+        """Cut off what a failed batch has written and close the active segment.
+
+        The segment the batch started in is truncated to its size before the batch and the
+        segments started since are removed, so the next batch starts a new segment instead of
+        appending to a file which failed. If this fails as well, no records are accepted any
+        more.
+        """
+        count, size, index_size = mark
+        for fd in (self.fd, self.index_fd):
+            if fd is not None:
+                try:
+                    os.close(fd)
+                except OSError:
+                    pass
+        self.fd = self.index_fd = None
+        try:
+            index = bytearray()
+            if count:
+                path = self.segmentPath(self.segments[count - 1])
+                with open(path[:-4] + ".idx", "rb") as file:
+                    index = bytearray(file.read() if size is None else file.read(index_size))
+            with self.lock:
+                started = self.segments[count:]
+                del self.segments[count:]
+                del self.segment_times[count:]
+                self.index = index
+            for seq in started:
+                os.unlink(self.segmentPath(seq))
+                os.unlink(self.segmentPath(seq)[:-4] + ".idx")
+            if size is not None:
+                os.truncate(path, size)
+                os.truncate(path[:-4] + ".idx", index_size)
+            readIndex.cache_clear()
+        except OSError as err:
+            self.error = err
+            print("[Log Error] %s: no longer accepting records" % (err), file=sys.stderr)
+
+    def closeSegment(self):
+        """Sync and close the active segment and its index, which are complete from now on."""
+        if self.fd is None:
+            return
+        if self.fsync != "none":
+            AppendWriter.sync(self.fd)
+            AppendWriter.sync(self.index_fd)
+        os.close(self.fd)
+        os.close(self.index_fd)
+        self.fd = self.index_fd = None
+
+    def segmentPath(self, seq):
+        """Return the path of the segment starting with record seq."""
+        return os.path.join(self.directory, "%020i.log" % (seq))
+
+    def recover(self):
+        """Load the segments of the log and continue the last one after its last valid record.
+
+        A record torn by a crash is cut off and the index is completed from the records.
+        """
+        names = [name for name in os.listdir(self.directory) if name.endswith(".log")]
+        for seq in sorted(int(name[:-4]) for name in names):
+            path = self.segmentPath(seq)
+            with open(path, "rb") as file:
+                first = next(readRecords(file), None)
+            if first is None:
+                # Nothing of it has made it to disk
+                os.unlink(path)
+                if os.path.exists(path[:-4] + ".idx"):
+                    os.unlink(path[:-4] + ".idx")
+                continue
+            self.segments.append(seq)
+            self.segment_times.append(first[1].time)
+        if not self.segments:
+            return
+
+        path = self.segmentPath(self.segments[-1])
+        try:
+            index = bytearray(readIndex(path[:-4] + ".idx"))
+        except FileNotFoundError:
+            index = bytearray()
+        readIndex.cache_clear()
+        # An entry torn by a crash would misalign all entries appended after it
+        del index[len(index) - len(index) % INDEX_ENTRY.size :]
+        size = os.path.getsize(path)
+        # Scan the records after the last index entry, dropping entries of records which are gone
+        while True:
+            last = None
+            indexed = end = IndexColumn(index, 2)[-1] if index else 0
+            with open(path, "rb") as file:
+                file.seek(end)
+                for offset, last in readRecords(file):
+                    if not index or offset - indexed >= self.INDEX_INTERVAL:
+                        index += INDEX_ENTRY.pack(last.seq, last.time, offset)
+                        indexed = offset
+                    end = offset + RECORD.size + len(last.data)
+            if last is not None or len(index) <= INDEX_ENTRY.size:
+                break
+            del index[-INDEX_ENTRY.size :]
+        self.next_seq = last.seq + 1
+        self.last_time = last.time
+        if end < size:
+            print(
+                "[Log Error] %s: cut off %i bytes of a torn record" % (path, size - end),
+                file=sys.stderr,
+            )
+            os.truncate(path, end)
+        with open(path[:-4] + ".idx", "wb") as file:
+            file.write(index)
+
+        self.fd = os.open(path, os.O_WRONLY | os.O_APPEND)
+        self.index_fd = os.open(path[:-4] + ".idx", os.O_WRONLY | os.O_APPEND)
+        self.index = index
+        self.size = end
+        self.indexed = indexed
+
+    # ---------------------------------------------------------------------------------------------
+    # Reading
+    # ---------------------------------------------------------------------------------------------
+
+    def read(self, seq=None, since=None, until=None, limit=100):
+        """Return up to limit records starting at sequence number seq and/or at time since.
+
+        Records at or after time until (if given) are left out, so a time range is paged
+        through with since first and then with the seq after the last record and until.
+        """
+        with self.lock:
+            segments = list(self.segments)
+            times = list(self.segment_times)
+            end = self.next_seq
+            active = bytes(self.index)
+        if seq is None and since is None:
+            seq = segments[0] if segments else 1
+
+        if seq is not None:
+            num = bisect.bisect_right(segments, seq) - 1
+        else:
+            num = bisect.bisect_left(times, since) - 1
+        records = []
+        for num in range(max(0, num), len(segments)):
+            if segments[num] >= end:
+                # Started by a batch which is not complete yet or has failed
+                break
+            path = self.segmentPath(segments[num])
+            index = active if num == len(segments) - 1 else readIndex(path[:-4] + ".idx")
+            # Last index entry before the first record wanted
+            if seq is not None:
+                entry = bisect.bisect_right(IndexColumn(index, 0), seq) - 1
+            else:
+                entry = bisect.bisect_left(IndexColumn(index, 1), since) - 1
+            offset = IndexColumn(index, 2)[entry] if entry >= 0 and not records else 0
+            with open(path, "rb") as file:
+                file.seek(offset)
+                for _, record in readRecords(file, end):
+                    if seq is not None and record.seq < seq:
+                        continue
+                    if since is not None and record.time < since:
+                        continue
+                    if until is not None and record.time >= until:
+                        return records
+                    records.append(record)
+                    if len(records) >= limit:
+                        return records
+        return records
@@ -0,0 +1,118 @@
+"""Serverhelper classes."""
+import os
+import signal
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import HTTPServer
+
+
+class PooledHTTPServer(HTTPServer):
+    """HTTPServer which handles its clients in a bounded pool of threads.
+
+    While all threads are busy no further clients are accepted, they wait in the
+    listen backlog of the kernel instead of piling up as threads.
+    """
+
+    def __init__(self, server_address, handler_class, threads=16, bind_and_activate=True):
+        """Create the server and its pool of threads."""
+        super().__init__(server_address, handler_class, bind_and_activate)
+        self.pool = ThreadPoolExecutor(max_workers=threads)
+        self.slots = threading.BoundedSemaphore(threads)
+
+    def process_request(self, request, client_address):
+        """Hand the client to the pool, blocks while all threads are busy."""
+        self.slots.acquire()
+        self.pool.submit(self.processRequestThread, request, client_address)
+
+    def processRequestThread(self, request, client_address):
+        """Handle a client inside a thread of the pool."""
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self.slots.release()
+
+    def server_close(self):
+        """Close the listening socket and wait for the clients being served."""
+        super().server_close()
+        self.pool.shutdown(wait=True)
+
+
+class ServerHelper:
+    """Runs a server until it is told to stop, gracefully."""
+
+    # Minimum seconds between two restarts of crashed workers
+    RESPAWN_DELAY = 1
+
+    @staticmethod
+    def serveForever(server):
+        """Serve until SIGTERM, then finish the requests in flight and close the server."""
+        # shutdown() waits for serve_forever() to return, so it must not run in its thread
+        signal.signal(
+            signal.SIGTERM, lambda signum, frame: threading.Thread(target=server.shutdown).start()
+        )
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+
+    @staticmethod
+    def serveWorkers(server, workers):
+        """Fork workers which all serve from the listening socket of server.
+
+        Crashed workers are restarted. On SIGTERM or SIGINT all workers are asked to
+        stop gracefully and this returns once all of them have exited.
+        """
+        children = {}
+        stopping = []
+
+        def spawn(num):
+            """Fork worker number num."""
+            sys.stdout.flush()
+            sys.stderr.flush()
+            pid = os.fork()
+            if pid == 0:
+                # Ctrl+c reaches the whole process group, the master takes care of it
+                signal.signal(signal.SIGINT, signal.SIG_IGN)
+                try:
+                    ServerHelper.serveForever(server)
+                finally:
+                    sys.stdout.flush()
+                    sys.stderr.flush()
+                    os._exit(0)
+            children[pid] = num
+
+        def stop(signum, frame):
+            """Ask all workers to stop."""
+            stopping.append(signum)
+            for pid in children:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+
+        for num in range(workers):
+            spawn(num)
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+
+        last_respawn = 0
+        while children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            num = children.pop(pid, None)
+            if num is None or stopping:
+                continue
+            print("worker %i (pid %i) exited with status %i" % (num, pid, status), file=sys.stderr)
+            # Don't turn a worker crashing on startup into a fork loop
+            time.sleep(max(0, last_respawn + ServerHelper.RESPAWN_DELAY - time.monotonic()))
+            last_respawn = time.monotonic()
+            spawn(num)
+
+        server.server_close()
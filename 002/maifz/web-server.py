@@ -1,59 +1,188 @@
 #!/usr/bin/env python3
 """Python webserver."""
 import argparse
+import json
+import os
 import sys
+import urllib.parse
 from http.server import HTTPServer
 from http.server import BaseHTTPRequestHandler
+from filehandler.filehandler import AppendWriter
 from filehandler.filehandler import FileHandler
 from argshelper.argshelper import ArgsHelper
+from filecache.filecache import FileCache
+from segmentlog.segmentlog import SegmentLog
+from serverhelper.serverhelper import PooledHTTPServer
+from serverhelper.serverhelper import ServerHelper
 
 
 class Webserver(BaseHTTPRequestHandler):
     """Main class, defines get and post handling."""
 
+    # Every response has a length, so connections can be kept alive
+    protocol_version = "HTTP/1.1"
+
+    # Headers and body are sent separately for large files
+    disable_nagle_algorithm = True
+
     file_handler = FileHandler()
 
     args_helper = ArgsHelper.getInstance()
 
+    # Set up once the arguments are known
+    index_cache = None
+    segment_log = None
+
+    # Path of the records of the segmented log
+    records_path = "/records"
+
+    # Most records sent for a single GET of records_path
+    max_records = 1000
+
     def do_GET(self):
         """Overwrite do_GET function of SimpleHTTPRequestHandler.
 
-        - serve file of passed path
+        - serve the index file from memory, 304 if the client has it already
+        - serve records of the segmented log under records_path
         - @throws 404 FileNotFoundError
         """
+        self.serve(head=False)
+
+    def do_HEAD(self):
+        """Answer like do_GET, just without the body."""
+        self.serve(head=True)
+
+    def serve(self, head):
+        """Send the records asked for or the index file."""
+        if (
+            Webserver.segment_log is not None
+            and urllib.parse.urlsplit(self.path).path == self.records_path
+        ):
+            self.serveRecords(head)
+        else:
+            self.serveIndex(head)
+
+    def serveRecords(self, head):
+        """Send records of the segmented log as JSON lines, found via its sparse index.
+
+        - seq: first sequence number to send
+        - since, until: time range of the records to send in unix seconds
+        - limit: most records to send - default= 100
+        - the X-Next-Seq header holds the seq to continue with, along with until for a time range
+        - @throws 400 for invalid parameters
+        """
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
         try:
-            self.wfile.write(Webserver.file_handler.readFile(self.args_helper.getIndexFilePath()))
-        except FileNotFoundError:
-            self.send_response(404)
+            params = {
+                name: kind(query[name][-1])
+                for name, kind in [("seq", int), ("since", float), ("until", float), ("limit", int)]
+                if name in query
+            }
+        except ValueError:
+            self.send_error(400, "Invalid number")
+            return
+        params["limit"] = max(1, min(params.get("limit", 100), self.max_records))
+
+        try:
+            records = Webserver.segment_log.read(**params)
+        except OSError as error:
+            self.send_error(500, str(error))
             return
+        body = "".join(
+            json.dumps({"seq": seq, "time": when, "data": data.decode("utf-8", "replace")}) + "\n"
+            for seq, when, data in records
+        ).encode("utf-8")
+        next_seq = records[-1].seq + 1 if records else params.get("seq", "")
 
         self.send_response(200)
-        self.send_header("Content-Type", self.args_helper.getContentType())
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("X-Next-Seq", str(next_seq))
         self.end_headers()
+        if not head:
+            self.wfile.write(body)
+
+    def serveIndex(self, head):
+        """Send the pre-encoded response of the cached index file."""
+        try:
+            entry = Webserver.index_cache.getEntry()
+        except FileNotFoundError:
+            self.send_error(404)
+            return
+
+        if FileCache.isNotModified(entry, self.headers):
+            self.writeResponse(304, entry.validators)
+        elif head:
+            self.writeResponse(200, entry.head)
+        elif entry.body is not None:
+            self.writeResponse(200, entry.head, entry.body)
+        else:
+            self.streamFile(entry)
+
+    def streamFile(self, entry):
+        """Send the headers of a file which is too large to be cached and then stream it."""
+        self.writeResponse(200, entry.head)
+        try:
+            sent = Webserver.file_handler.sendFile(
+                Webserver.index_cache.file_path, self.connection, entry.size
+            )
+        except OSError as error:
+            self.log_error("Streaming failed: %s", error)
+            sent = None
+        # The file has changed or vanished since its headers have been sent
+        if sent != entry.size:
+            self.close_connection = True
+
+    def writeResponse(self, code, head, body=b""):
+        """Write the status line, pre-encoded headers and body with a single call."""
+        self.log_request(code)
+        status = "%s %i %s\r\nServer: %s\r\nDate: %s\r\n" % (
+            self.protocol_version,
+            code,
+            self.responses[code][0],
+            self.version_string(),
+            self.date_time_string(),
+        )
+        self.wfile.write(status.encode("latin-1") + head + body)
 
     def do_POST(self):
         """Overwrite post function of SimpleHTTPRequestHandler.
 
-        - write posted text into file of given path
+        - write posted text into file of given path or the segmented log
         - send 404 if file is not existing
+        - the X-Seq header holds the sequence number of the record in the segmented log
         """
         try:
             content_length = int(self.headers["Content-Length"])
             post_data = self.rfile.read(content_length)
         except TypeError:
-            self.send_response(411)
+            # The body cannot be told apart from the next request
+            self.close_connection = True
+            self.send_error(411)
             return
 
-        response = Webserver.file_handler.appendToFile(
-            self.args_helper.getWriteFilePath(), post_data
-        )
+        seq = None
+        try:
+            if Webserver.segment_log is not None:
+                seq = Webserver.segment_log.append(post_data)
+                response = True
+            else:
+                response = Webserver.file_handler.appendToFile(
+                    self.args_helper.getWriteFilePath(), post_data
+                )
+        except OSError as error:
+            self.send_error(500, str(error))
+            return
 
         if not response:
-            self.send_response(404)
+            self.send_error(404)
             return
 
         self.send_response(200)
-        print(post_data)
+        self.send_header("Content-Length", "0")
+        if seq is not None:
+            self.send_header("X-Seq", str(seq))
+        self.end_headers()
 
 
 PORT = 8000
@@ -61,12 +190,33 @@ SERVER_ADDRESS = "127.0.0.1"
 CONTENT_TYPE = "text/plain"
 DEFAULT_FILE = "test.txt"
 DEFAULT_INDEX_FILE = "index.html"
+MODES = ["single", "threaded", "prefork"]
+DEFAULT_MODE = "threaded"
+THREADS = 16
+WORKERS = os.cpu_count() or 1
+TIMEOUT = 10
+DEFAULT_FSYNC = "batch"
+FSYNC_INTERVAL = 1.0
+SEGMENT_SIZE = 67108864
+SEGMENT_AGE = 3600
 
 
-def run_server(server_address, port):
-    """Initialize HTTPServer object and runs the server."""
-    server = HTTPServer((server_address, port), Webserver)
-    server.serve_forever()
+def run_server(server_address, port, mode=DEFAULT_MODE, threads=THREADS, workers=WORKERS):
+    """Initialize the server object of the given mode and run it until SIGTERM.
+
+    - single: one request after the other
+    - threaded: a pool of threads serves the clients
+    - prefork: worker processes, each with a pool of threads, share the listening socket
+    """
+    if mode == "single":
+        server = HTTPServer((server_address, port), Webserver)
+    else:
+        server = PooledHTTPServer((server_address, port), Webserver, threads)
+
+    if mode == "prefork":
+        ServerHelper.serveWorkers(server, workers)
+    else:
+        ServerHelper.serveForever(server)
 
 
 def main():
@@ -112,11 +262,100 @@ def main():
         help="file-path to your index.html",
         dest="index_file_path",
     )
+    parser.add_argument(
+        "-m",
+        "--mode",
+        choices=MODES,
+        default=DEFAULT_MODE,
+        help="How to serve concurrent clients - default= " + str(DEFAULT_MODE),
+    )
+    parser.add_argument(
+        "-th",
+        "--threads",
+        type=int,
+        default=THREADS,
+        help="Threads serving clients in threaded and prefork mode (per worker) - default= "
+        + str(THREADS),
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=WORKERS,
+        help="Worker processes in prefork mode - default= number of CPUs",
+    )
+    parser.add_argument(
+        "-to",
+        "--timeout",
+        type=float,
+        default=TIMEOUT,
+        help="Seconds after which idle or slow clients are disconnected - default= " + str(TIMEOUT),
+    )
+    parser.add_argument(
+        "-fs",
+        "--fsync",
+        choices=AppendWriter.FSYNC,
+        default=DEFAULT_FSYNC,
+        help="When POST data is synced to disk, none: left to the kernel, interval: every "
+        "--fsync-interval seconds, batch: before a POST is answered, shared by all POSTs "
+        "arriving meanwhile - default= " + str(DEFAULT_FSYNC),
+    )
+    parser.add_argument(
+        "-fi",
+        "--fsync-interval",
+        type=float,
+        default=FSYNC_INTERVAL,
+        help="Seconds between two syncs with --fsync interval - default= " + str(FSYNC_INTERVAL),
+    )
+    parser.add_argument(
+        "-ld",
+        "--log-dir",
+        type=str,
+        default=None,
+        help="Directory of a segmented log to write POST data to instead of --file-path, "
+        "its records are served under " + Webserver.records_path,
+        dest="log_dir",
+    )
+    parser.add_argument(
+        "-ss",
+        "--segment-size",
+        type=int,
+        default=SEGMENT_SIZE,
+        help="Bytes after which a new segment of the log is started - default= "
+        + str(SEGMENT_SIZE),
+    )
+    parser.add_argument(
+        "-sa",
+        "--segment-age",
+        type=float,
+        default=SEGMENT_AGE,
+        help="Seconds after which a new segment of the log is started - default= "
+        + str(SEGMENT_AGE),
+    )
     args = parser.parse_args()
+    if args.threads < 1 or args.workers < 1:
+        parser.error("threads and workers must be at least 1")
+    if args.segment_size < 1 or args.segment_age <= 0:
+        parser.error("segment size and age must be positive")
+    if args.log_dir is not None and args.mode == "prefork":
+        # Sequence numbers are handed out by a single process
+        parser.error("--log-dir cannot be used with --mode prefork")
     args_helper = ArgsHelper.getInstance()
     args_helper.initializeArguments(args.type, args.file_path, args.index_file_path)
+    Webserver.timeout = args.timeout
+    Webserver.file_handler = FileHandler(args.fsync, args.fsync_interval)
+    Webserver.index_cache = FileCache(args_helper.getIndexFilePath(), args_helper.getContentType())
+    if args.log_dir is not None:
+        Webserver.segment_log = SegmentLog(
+            args.log_dir, args.segment_size, args.segment_age, args.fsync, args.fsync_interval
+        )
 
-    run_server(args.listen, args.port)
+    try:
+        run_server(args.listen, args.port, args.mode, args.threads, args.workers)
+    finally:
+        Webserver.file_handler.close()
+        if Webserver.segment_log is not None:
+            Webserver.segment_log.close()
 
 
 if __name__ == "__main__":
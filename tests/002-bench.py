@@ -0,0 +1,501 @@
+#!/usr/bin/env python3
+"""Load generator to benchmark the webservers of project 002 on loopback."""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+
+# -------------------------------------------------------------------------------------------------
+# GLOBALS
+# -------------------------------------------------------------------------------------------------
+
+SCRIPTPATH = os.path.dirname(os.path.abspath(__file__))
+
+# Server script of every implementation, relative to the repository root
+SERVERS = {
+    "cytopia": "002/cytopia/httpd.py",
+    "maifz": "002/maifz/web-server.py",
+}
+
+# Connection handling of the clients: reuse connections or open one per request
+MODES = ["keepalive", "close"]
+
+# Seconds to wait for a started server to accept connections
+STARTUP_TIMEOUT = 10
+
+# Seconds a single request may take before it counts as error
+REQUEST_TIMEOUT = 10
+
+# Bytes requested per recv() call by the clients
+RECV_SIZE = 65536
+
+
+# -------------------------------------------------------------------------------------------------
+# SERVERS
+# -------------------------------------------------------------------------------------------------
+
+
+def create_docroot(sizes):
+    """Create a temporary directory with one file of random bytes per size."""
+    docroot = tempfile.mkdtemp(prefix="bench-002-")
+    for size in sizes:
+        with open(os.path.join(docroot, "%i.bin" % (size)), "wb") as f:
+            f.write(os.urandom(size))
+    return docroot
+
+
+def free_port():
+    """Return a loopback port nobody listens on (and without connections in TIME_WAIT)."""
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def server_command(impl, port, docroot, size, extra_args):
+    """Return the command line to start the server of impl, serving the file of size."""
+    script = os.path.join(SCRIPTPATH, os.pardir, SERVERS[impl])
+    if impl == "maifz":
+        # Serves its index file for every path, so there is one server per file size
+        index = os.path.join(docroot, "%i.bin" % (size))
+        args = ["-l", "127.0.0.1", "-p", str(port), "-ip", index]
+    else:
+        args = ["-r", docroot, "127.0.0.1", str(port)]
+    return [sys.executable, script] + extra_args + args
+
+
+def start_server(command, port):
+    """Start a server and return its process once it accepts connections."""
+    # The maifz server has to be started from within its directory to find its modules
+    proc = subprocess.Popen(
+        command,
+        cwd=os.path.dirname(command[1]),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            break
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return proc
+        except OSError:
+            time.sleep(0.1)
+    stop_server(proc)
+    print("[Server Error] %s did not start" % (" ".join(command)), file=sys.stderr)
+    sys.exit(1)
+
+
+def stop_server(proc):
+    """Stop a server gracefully and kill it if it does not exit in time."""
+    if proc.poll() is None:
+        proc.terminate()
+        try:
+            proc.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+
+
+# -------------------------------------------------------------------------------------------------
+# CLIENTS
+# -------------------------------------------------------------------------------------------------
+
+
+class ResponseError(Exception):
+    """Raised by the client for responses which are not a complete 200 with the file."""
+
+
+def request(s, path, keep_alive, size):
+    """Send a GET request and read the response, return True if the connection can be reused."""
+    connection = "keep-alive" if keep_alive else "close"
+    s.sendall(
+        b"GET %s HTTP/1.1\r\nHost: 127.0.0.1\r\nConnection: %s\r\n\r\n"
+        % (path.encode(), connection.encode())
+    )
+
+    # Response head
+    data = b""
+    while b"\r\n\r\n" not in data:
+        chunk = s.recv(RECV_SIZE)
+        if not chunk:
+            raise ResponseError("connection closed before the response head")
+        data += chunk
+    head, body = data.split(b"\r\n\r\n", 1)
+    lines = head.decode("latin-1").split("\r\n")
+    parts = lines[0].split(" ", 2)
+    if len(parts) < 2 or not parts[0].startswith("HTTP/"):
+        raise ResponseError("bad status line %r" % (lines[0][:40]))
+    if parts[1] != "200":
+        raise ResponseError("status %s" % (parts[1]))
+    headers = {}
+    for line in lines[1:]:
+        name, _, value = line.partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+    # Response body, delimited by its length or by the server closing the connection
+    received = len(body)
+    length = headers.get("content-length")
+    if length is not None:
+        while received < int(length):
+            chunk = s.recv(RECV_SIZE)
+            if not chunk:
+                raise ResponseError("connection closed before the response body")
+            received += len(chunk)
+    else:
+        while True:
+            chunk = s.recv(RECV_SIZE)
+            if not chunk:
+                break
+            received += len(chunk)
+    if received != size:
+        raise ResponseError("received %i of %i bytes" % (received, size))
+
+    reusable = keep_alive and length is not None
+    return reusable and headers.get("connection", "").lower() != "close"
+
+
+def client(port, path, size, keep_alive, start, deadline, results):
+    """Send requests until deadline and put (latencies, errors, bytes) into results."""
+    latencies = []
+    errors = 0
+    received = 0
+    s = None
+
+    # All clients start at the same time
+    time.sleep(max(0, start - time.time()))
+    while time.time() < deadline:
+        begin = time.perf_counter()
+        try:
+            if s is None:
+                s = socket.create_connection(("127.0.0.1", port), timeout=REQUEST_TIMEOUT)
+                s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            reusable = request(s, path, keep_alive, size)
+        except (OSError, ResponseError, ValueError):
+            errors += 1
+            reusable = False
+        else:
+            latencies.append(time.perf_counter() - begin)
+            received += size
+        if not reusable and s is not None:
+            s.close()
+            s = None
+
+    if s is not None:
+        s.close()
+    results.put((latencies, errors, received))
+
+
+def percentile(values, pct):
+    """Return the percentile of sorted values (nearest rank) in milliseconds."""
+    if not values:
+        return None
+    rank = max(0, int(round(pct / 100.0 * len(values))) - 1)
+    return round(values[rank] * 1000, 3)
+
+
+def run_load(port, path, size, concurrency, keep_alive, duration):
+    """Run concurrency client processes for duration seconds and return their summary."""
+    results = multiprocessing.Queue()
+    # Leave the clients time to be forked before the clock starts
+    start = time.time() + 0.5
+    deadline = start + duration
+    procs = []
+    for _ in range(concurrency):
+        proc = multiprocessing.Process(
+            target=client, args=(port, path, size, keep_alive, start, deadline, results)
+        )
+        proc.start()
+        procs.append(proc)
+
+    latencies = []
+    errors = 0
+    received = 0
+    for _ in procs:
+        lats, errs, recv = results.get()
+        latencies += lats
+        errors += errs
+        received += recv
+    for proc in procs:
+        proc.join()
+
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": round(len(latencies) / duration, 1),
+        "mb_per_s": round(received / duration / 1048576, 2),
+        "p50_ms": percentile(latencies, 50),
+        "p95_ms": percentile(latencies, 95),
+        "p99_ms": percentile(latencies, 99),
+    }
+
+
+# -------------------------------------------------------------------------------------------------
+# BENCHMARK
+# -------------------------------------------------------------------------------------------------
+
+
+def run_benchmark(impl, fixed_port, sizes, concurrencies, modes, duration, extra_args):
+    """Benchmark a server for every combination of file size, concurrency and mode."""
+    docroot = create_docroot(sizes)
+    results = []
+    proc = None
+    try:
+        for size in sizes:
+            # One server for all sizes, unless it can only serve a single file
+            if proc is None or impl == "maifz":
+                if proc is not None:
+                    stop_server(proc)
+                # Ports of stopped servers are blocked by connections in TIME_WAIT
+                port = fixed_port or free_port()
+                command = server_command(impl, port, docroot, size, extra_args)
+                proc = start_server(command, port)
+            for concurrency in concurrencies:
+                for mode in modes:
+                    result = {"size": size, "concurrency": concurrency, "mode": mode}
+                    result.update(
+                        run_load(
+                            port, "/%i.bin" % (size), size, concurrency, mode == MODES[0], duration
+                        )
+                    )
+                    print_result(result)
+                    results.append(result)
+    finally:
+        if proc is not None:
+            stop_server(proc)
+        shutil.rmtree(docroot)
+    return results
+
+
+def print_header():
+    """Print the header of the result table."""
+    columns = ["size", "conc", "mode", "requests", "errors", "rps", "MB/s", "p50 ms", "p95 ms"]
+    print("%10s %5s %-9s %9s %7s %10s %9s %9s %9s %9s" % tuple(columns + ["p99 ms"]))
+
+
+def print_result(result):
+    """Print a single row of the result table."""
+    row = dict(result)
+    for key in ["p50_ms", "p95_ms", "p99_ms"]:
+        row[key] = "-" if row[key] is None else "%.3f" % (row[key])
+    print(
+        "%(size)10i %(concurrency)5i %(mode)-9s %(requests)9i %(errors)7i %(rps)10.1f "
+        "%(mb_per_s)9.2f %(p50_ms)9s %(p95_ms)9s %(p99_ms)9s" % row,
+        flush=True,
+    )
+
+
+def compare(baseline, results, tolerance):
+    """Print how results differ from a baseline and return the number of regressions.
+
+    A run regresses if its rps dropped or its p99 latency rose by more than tolerance,
+    or if it has errors which the baseline run did not have.
+    """
+    runs = {(r["size"], r["concurrency"], r["mode"]): r for r in baseline["results"]}
+    regressions = 0
+    print("\nCompared to %s (tolerance %i%%)" % (baseline["server"], tolerance * 100))
+    for result in results:
+        old = runs.get((result["size"], result["concurrency"], result["mode"]))
+        if old is None:
+            continue
+        problems = []
+        if old["rps"] and result["rps"] < old["rps"] * (1 - tolerance):
+            problems.append("rps %.1f -> %.1f" % (old["rps"], result["rps"]))
+        old_p99, new_p99 = old["p99_ms"], result["p99_ms"]
+        if old_p99 and new_p99 and new_p99 > old_p99 * (1 + tolerance):
+            problems.append("p99 %.3f -> %.3f ms" % (old_p99, new_p99))
+        if result["errors"] and not old["errors"]:
+            problems.append("%i errors" % (result["errors"]))
+        change = (result["rps"] / old["rps"] - 1) * 100 if old["rps"] else 0
+        print(
+            "%10i %5i %-9s rps %+6.1f%% %s"
+            % (
+                result["size"],
+                result["concurrency"],
+                result["mode"],
+                change,
+                "REGRESSION: " + ", ".join(problems) if problems else "ok",
+            )
+        )
+        regressions += bool(problems)
+    return regressions
+
+
+# -------------------------------------------------------------------------------------------------
+# COMMAND LINE ARGUMENTS
+# -------------------------------------------------------------------------------------------------
+
+
+def _args_check_list(value):
+    """Check arguments for a comma separated list of positive integers."""
+    try:
+        values = [int(item) for item in value.split(",")]
+    except ValueError:
+        raise argparse.ArgumentTypeError("%s is not a list of numbers." % value)
+    if not values or min(values) < 1:
+        raise argparse.ArgumentTypeError("%s must only contain numbers above 0." % value)
+    return values
+
+
+def _args_check_modes(value):
+    """Check arguments for a comma separated list of connection modes."""
+    modes = value.split(",")
+    for mode in modes:
+        if mode not in MODES:
+            raise argparse.ArgumentTypeError("%s is not one of %s." % (mode, ", ".join(MODES)))
+    return modes
+
+
+def get_args():
+    """Retrieve command line arguments."""
+    parser = argparse.ArgumentParser(
+        description="Benchmark a webserver of project 002 on loopback.",
+        epilog="Arguments after -- are passed to the server, e.g.: cytopia -- -e asyncio -w 4",
+    )
+    parser.add_argument("server", choices=sorted(SERVERS), help="implementation to benchmark")
+    parser.add_argument(
+        "-s",
+        "--sizes",
+        metavar="BYTES",
+        type=_args_check_list,
+        default=[1024, 65536, 1048576],
+        required=False,
+        help="comma separated sizes of the requested files (default: 1024,65536,1048576)",
+    )
+    parser.add_argument(
+        "-c",
+        "--concurrency",
+        metavar="NUM",
+        type=_args_check_list,
+        default=[1, 8, 32],
+        required=False,
+        help="comma separated numbers of client processes (default: 1,8,32)",
+    )
+    parser.add_argument(
+        "-m",
+        "--modes",
+        metavar="MODES",
+        type=_args_check_modes,
+        default=MODES,
+        required=False,
+        help="comma separated connection modes, keepalive: reuse connections, close: one "
+        "connection per request (default: keepalive,close)",
+    )
+    parser.add_argument(
+        "-d",
+        "--duration",
+        metavar="SECONDS",
+        type=float,
+        default=5,
+        required=False,
+        help="seconds of load per run (default: 5)",
+    )
+    parser.add_argument(
+        "-p",
+        "--port",
+        type=int,
+        default=0,
+        required=False,
+        help="loopback port for the server (default: 0, a free one for every server started)",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        metavar="FILE",
+        required=False,
+        help="write the results as JSON to this file (default: bench-002-SERVER-TIME.json)",
+    )
+    parser.add_argument(
+        "-b",
+        "--baseline",
+        metavar="FILE",
+        required=False,
+        help="compare against the results of an earlier run and exit with 1 on regressions",
+    )
+    parser.add_argument(
+        "--tolerance",
+        metavar="PERCENT",
+        type=float,
+        default=10,
+        required=False,
+        help="change in rps or p99 latency against the baseline which counts as regression "
+        "(default: 10)",
+    )
+    argv = sys.argv[1:]
+    server_args = []
+    if "--" in argv:
+        server_args = argv[argv.index("--") + 1 :]
+        argv = argv[: argv.index("--")]
+    args = parser.parse_args(argv)
+    args.server_args = server_args
+    if args.output is None:
+        args.output = "bench-002-%s-%s.json" % (args.server, time.strftime("%Y%m%d-%H%M%S"))
+    if args.baseline and os.path.realpath(args.output) == os.path.realpath(args.baseline):
+        parser.error("the results would overwrite the baseline %s" % (args.baseline))
+    return args
+
+
+# -------------------------------------------------------------------------------------------------
+# MAIN ENTRYPOINT
+# -------------------------------------------------------------------------------------------------
+
+
+def main():
+    """Start the program."""
+    args = get_args()
+    output = args.output
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    print_header()
+    results = run_benchmark(
+        args.server,
+        args.port,
+        args.sizes,
+        args.concurrency,
+        args.modes,
+        args.duration,
+        args.server_args,
+    )
+
+    report = {
+        "server": args.server,
+        "server_args": args.server_args,
+        "duration": args.duration,
+        "date": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "results": results,
+    }
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+        f.write("\n")
+    print("\nResults written to %s" % (output))
+
+    if baseline is not None and compare(baseline, results, args.tolerance / 100):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    # Catch Ctrl+c and exit without error message
+    try:
+        main()
+    except KeyboardInterrupt:
+        print()
+        sys.exit(1)